@@ -44,6 +44,7 @@ INSTALLED_APPS = (
     # shopkit apps
     'shopkit.core',
     'shopkit.contrib.product.category',
+    'shopkit.contrib.stock.reservation',
 
     # shop apps
     'shop.core',
@@ -65,6 +66,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'shopkit.cart.middleware.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -144,6 +146,9 @@ STATICFILES_DIRS = (
 # Satchless settings
 # ------------------
 SATCHLESS_DEFAULT_CURRENCY = 'RUR'
+SATCHLESS_SHOP_APP = 'shop.core.app.shop_app'
+SATCHLESS_CART_TOKEN_STORAGE = 'shopkit.cart.tokens.SessionCartTokenStorage'
+SATCHLESS_CART_STORAGE = 'shopkit.cart.storage.DatabaseCartStorage'
 SATCHLESS_ORDER_PARTITIONERS = [
     'shopkit.contrib.order.partitioner.simple.SimplePhysicalPartitioner',
 ]
@@ -153,3 +158,4 @@ SATCHLESS_DELIVERY_PROVIDERS = [
 SATCHLESS_PAYMENT_PROVIDERS = [
     'shop.payments.SimplePaymentProvider',
 ]
+SATCHLESS_STOCK_RESERVATION_TIMEOUT = 15  # minutes
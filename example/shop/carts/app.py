@@ -10,22 +10,12 @@ class CartApp(app.CartApp):
     CartLineReplaceForm = forms.CartLineReplaceForm
 
     def get_cart_for_request(self, request, previous_for_merge=False):
-        token = request.session.get(self.cart_session_key, None)
-        user = request.user if request.user.is_authenticated else None
-
         if previous_for_merge:
-            return self.Cart.objects.filter(token=token).first()
-
-        if user:
-            cart = user.carts.first() or self.Cart(user=user)
-        elif token:
-            cart = (self.Cart.objects.filter(token=token).first() or
-                    self.Cart(token=token))
-        else:
-            cart = self.Cart()
-            request.session[self.cart_session_key] = cart.token
+            token = self.cart_token_storage.get_token(request)
+            return token and (self.Cart.objects.filter(token=token).first() or
+                              self.Cart(token=token))
 
-        return cart
+        return super(CartApp, self).get_cart_for_request(request)
 
     # Views methods section
     # ---------------------
@@ -33,4 +23,5 @@ class CartApp(app.CartApp):
         return [
             url(r'^fixcart/$', self.fix_cart_lines, name='fix-cart-lines'),
             url(r'^view/$', self.cart_view, name='details'),
+            url(r'^summary/$', self.cart_summary, name='summary'),
         ]
@@ -14,18 +14,8 @@ def user_logged_in_listener(sender, user, request, **kwargs):
     if not cart_old:
         return
 
-    # merge cart lines from old and new cart
-    for line_old in cart_old.lines.all():
-        line_new = cart_new.get_line(line_old.variant, data=line_old.data)
-        quantity = max(line_old.quantity,
-                       line_new.quantity if line_new is not None else 0)
-        cart_new.add(
-            line_old.variant, quantity=quantity, data=line_old.data,
-            replace=True, check_quantity=False)
-
-    # clear all old cart lines
-    for line in cart_old.lines.all():
-        line.delete()
+    # merge cart lines from old cart to new one and clear old cart
+    cart_new.merge_from(cart_old, strategy='max')
 
 
 def start_listening():
@@ -1,8 +1,11 @@
 from shopkit.cart import models
+from shopkit.contrib.stock.reservation import models as reservemodels
 
 
-class Cart(models.Cart):
-    pass
+class Cart(reservemodels.CartStockReservationMixin, models.Cart):
+    lines_select_related = (
+        'variant__product__discount', 'variant__product__tax',)
+    lines_prefetch_related = ('variant__product__qty_price_overrides',)
 
 
 class CartLine(models.CartLine):
@@ -0,0 +1,484 @@
+import datetime
+import json
+from decimal import Decimal
+from unittest import skipUnless
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import (RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.utils import timezone
+from django.utils.six import StringIO
+from satchless.item import InsufficientStock
+from shopkit.cart import signals
+from shopkit.cart.dispatch import dispatcher
+from shopkit.cart.forms import CartLineAddForm
+from shopkit.cart.middleware import CartMiddleware
+from shopkit.cart.storage import DatabaseCartStorage, get_data_key
+from shopkit.cart.tokens import SignedCookieCartTokenStorage
+from shop.core.app import shop_app
+from shop.products.models import Product, Variant
+from shop.orders.models import Order
+from .app import CartApp
+from .models import Cart, CartLine
+
+CACHE_CART_STORAGE = 'shopkit.cart.storage.CacheCartStorage'
+
+
+class CartStockReservationTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=5, size='M', color='red')
+        self.cart = Cart.objects.create()
+        self.cart.add(self.variant, 3)
+        # checkout holds 3 items for cart's order
+        shop_app.checkout_app.get_order_from_cart(None, self.cart)
+
+    def test_own_holds_are_available(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        cart.add(self.variant, 2)
+        self.assertEqual(cart.get_line(self.variant).quantity, 5)
+        with self.assertRaises(InsufficientStock):
+            cart.add(self.variant, 1)
+
+    def test_other_holds_are_not_available(self):
+        cart = Cart.objects.create()
+        cart.add(self.variant, 2)
+        with self.assertRaises(InsufficientStock):
+            cart.add(self.variant, 1)
+
+    def test_add_form_excludes_own_holds(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        form = CartLineAddForm(data={'quantity': 2}, cart=cart,
+                               product=self.variant.product)
+        form.get_variant = lambda cleaned_data: self.variant
+        self.assertTrue(form.is_valid(), form.errors)
+
+        form = CartLineAddForm(data={'quantity': 3}, cart=cart,
+                               product=self.variant.product)
+        form.get_variant = lambda cleaned_data: self.variant
+        self.assertFalse(form.is_valid())
+
+
+class CartLineUpsertTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=10, size='M', color='red')
+        self.cart = Cart.objects.create()
+
+    def test_stale_carts_add_to_same_line(self):
+        # second cart instance does not know about line added by first one
+        other = Cart.objects.get(pk=self.cart.pk)
+        len(other)
+        self.cart.add(self.variant, 2)
+        line = other.add(self.variant, 3)
+        self.assertEqual(line.quantity, 5)
+        self.assertEqual(self.cart.lines.get().quantity, 5)
+        self.assertEqual(Cart.objects.values_list(
+            'line_count', 'total_quantity').get(), (1, 5))
+
+        other.add(self.variant, 1, replace=True)
+        self.assertEqual(self.cart.lines.get().quantity, 1)
+
+        self.cart.add(self.variant, -1)
+        self.assertFalse(self.cart.lines.exists())
+
+    @skipUnless(DatabaseCartStorage().can_upsert_lines(Cart()),
+                'INSERT ... ON CONFLICT is not supported by %s'
+                % connection.vendor)
+    def test_upsert_line_on_conflict(self):
+        storage = DatabaseCartStorage()
+        pk, quantity = storage.upsert_line(self.cart, self.variant, 2, None)
+        self.assertEqual(quantity, 2)
+        self.assertEqual(storage.upsert_line(
+            self.cart, self.variant, 3, None), (pk, 5))
+        # lines with other data are not in conflict
+        other_pk, quantity = storage.upsert_line(
+            self.cart, self.variant, 1, {'gift': True})
+        self.assertNotEqual(other_pk, pk)
+        self.assertEqual(self.cart.lines.count(), 2)
+
+
+class CartCountersTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variants = [
+            Variant.objects.create(product=product, stock_level=10,
+                                   size='M', color='red')
+            for i in range(2)]
+        self.cart = Cart.objects.create()
+
+    def get_counters(self):
+        return Cart.objects.values_list('line_count', 'total_quantity').get(
+            pk=self.cart.pk)
+
+    def test_stale_carts_counters(self):
+        other = Cart.objects.get(pk=self.cart.pk)
+        self.cart.add(self.variants[0], 2)
+        other.add(self.variants[1], 3)
+        other.add(self.variants[0], 1)
+        self.assertEqual(self.get_counters(), (2, 6))
+
+        self.cart.add(self.variants[0], 1, replace=True)
+        self.cart.add_many([(self.variants[1], 1, None)])
+        self.assertEqual(self.get_counters(), (2, 5))
+
+        other.add(self.variants[1], -4)
+        self.assertEqual(self.get_counters(), (1, 1))
+
+        Cart.objects.get(pk=self.cart.pk).merge_from(Cart.objects.create())
+        other.get_storage().clear(other)
+        self.assertEqual(self.get_counters(), (0, 0))
+
+    def test_write_does_not_price_cart(self):
+        self.cart.add(self.variants[0], 2)
+        cart = Cart.objects.get(pk=self.cart.pk)
+        self.assertEqual(cart.total_version, '')
+        with self.assertNumQueries(3):
+            # loading of lines (with price overrides) and total caching
+            self.assertEqual(cart.get_cached_total().gross, 20)
+        with self.assertNumQueries(1):
+            Cart.objects.get(pk=self.cart.pk).get_cached_total()
+
+    def test_price_change_invalidates_cached_total(self):
+        self.cart.add(self.variants[0], 2)
+        Cart.objects.get(pk=self.cart.pk).get_cached_total()
+        product = Product.objects.get()
+        product.price = 20
+        product.save()
+        self.assertEqual(
+            Cart.objects.get(pk=self.cart.pk).get_cached_total().gross, 40)
+
+    def test_total_of_changed_cart_is_not_cached(self):
+        self.cart.add(self.variants[0], 2)
+        stale = Cart.objects.get(pk=self.cart.pk)
+        self.cart.add(self.variants[1], 1)
+        self.assertEqual(stale.get_cached_total().gross, 30)
+        self.assertEqual(Cart.objects.get(pk=self.cart.pk).total_version, '')
+        self.assertEqual(
+            Cart.objects.get(pk=self.cart.pk).get_cached_total().gross, 30)
+
+
+class CartSummaryTest(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='product', price=10)
+        variants = [
+            Variant.objects.create(product=self.product, stock_level=10,
+                                   size='M', color='red')
+            for i in range(2)]
+        self.cart = Cart.objects.create()
+        self.cart.add_many([(variants[0], 1, None), (variants[1], 2, None)])
+
+    def get_summary(self, **headers):
+        request = RequestFactory().get('/', **headers)
+        SessionMiddleware().process_request(request)
+        request.session[shop_app.cart_app.cart_session_key] = self.cart.token
+        request.user = AnonymousUser()
+        return shop_app.cart_app.cart_summary(request)
+
+    def test_summary_is_revalidated(self):
+        response = self.get_summary()
+        summary = json.loads(response.content)
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['quantity'], 3)
+        self.assertEqual(Decimal(summary['price']), 30)
+        self.assertEqual(self.get_summary(
+            HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_price_change_changes_summary(self):
+        etag = self.get_summary()['ETag']
+        # cached total of cart is not used by summary
+        Cart.objects.get(pk=self.cart.pk).get_cached_total()
+        self.product.price = 20
+        self.product.save()
+
+        response = self.get_summary(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        summary = json.loads(response.content)
+        self.assertEqual(Decimal(summary['price']), 60)
+        self.assertEqual(sum(Decimal(line['price'])
+                             for line in summary['lines'].values()), 60)
+
+
+@override_settings(SATCHLESS_CART_STORAGE=CACHE_CART_STORAGE)
+class CacheCartStorageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=10, size='M', color='red')
+        self.user = User.objects.create(username='user')
+
+    def test_concurrent_adds_are_not_lost(self):
+        first, second = Cart(token='token'), Cart(token='token')
+        # both carts snapshots are loaded before any write
+        self.assertEqual(first.get_lines() + second.get_lines(), [])
+        first.add(self.variant, 1)
+        self.assertEqual(second.add(self.variant, 2).quantity, 3)
+        self.assertEqual(second.total_quantity, 3)
+
+        cart = Cart(token='token')
+        self.assertEqual([line.quantity for line in cart], [3])
+        self.assertFalse(cache.get(
+            '%s:lock' % cart.get_storage().get_key(cart)))
+
+    def test_concurrent_add_many_are_not_lost(self):
+        first, second = Cart(token='token'), Cart(token='token')
+        self.assertEqual(first.get_lines() + second.get_lines(), [])
+        first.add_many([(self.variant, 1, None)])
+        second.add_many([(self.variant, 2, None)])
+        self.assertEqual([line.quantity for line in Cart(token='token')], [3])
+
+    def test_user_cart_keeps_token(self):
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+        cart_app = shop_app.cart_app
+        cart = cart_app.load_cart_for_request(request, user=self.user)
+        cart.add(self.variant, 1)
+
+        loaded = cart_app.load_cart_for_request(request, user=self.user)
+        self.assertIsNone(loaded.pk)
+        self.assertEqual(loaded.token, cart.token)
+        self.assertEqual([line.quantity for line in loaded], [1])
+
+        loaded.materialize()
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(cart.token, loaded.token)
+        self.assertEqual(cart.lines.get().quantity, 1)
+
+
+class CartLineFormSetTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=5, size='M', color='red')
+        self.cart = Cart.objects.create()
+        self.cart.add_many([(self.variant, 1, {'engraving': 'a'}),
+                            (self.variant, 2, {'engraving': 'b'})])
+
+    def get_formset(self, quantity):
+        return shop_app.cart_app.CartLineFormSet(
+            data={'cartline-%d-quantity' % self.variant.pk: quantity},
+            cart=Cart.objects.get(pk=self.cart.pk),
+            form_class=shop_app.cart_app.CartLineReplaceForm)
+
+    def test_stock_errors_of_lines_with_same_variant(self):
+        formset = self.get_formset(6)
+        self.assertFalse(formset.is_valid())
+        self.assertEqual([len(form.errors['quantity']) for form in formset],
+                         [1, 1])
+
+    def test_valid_quantities_are_saved(self):
+        formset = self.get_formset(4)
+        self.assertTrue(formset.is_valid())
+        formset.save()
+        self.assertEqual(sorted(self.cart.lines.values_list(
+            'quantity', flat=True)), [4, 4])
+
+
+class CartTokenStorageTest(TestCase):
+    def test_storage_by_unicode_path(self):
+        cart_app = CartApp(cart_token_storage=(
+            u'shopkit.cart.tokens.SignedCookieCartTokenStorage'))
+        self.assertIsInstance(cart_app.cart_token_storage,
+                              SignedCookieCartTokenStorage)
+        self.assertEqual(cart_app.cart_token_storage.name,
+                         cart_app.cart_session_key)
+
+    def test_signed_cookie_token(self):
+        storage = SignedCookieCartTokenStorage()
+        response = HttpResponse()
+        storage.set_token(RequestFactory().get('/'), response, 'token')
+        cookie = response.cookies[storage.name]
+        self.assertTrue(cookie['httponly'])
+
+        request = RequestFactory().get('/')
+        request.COOKIES[storage.name] = cookie.value
+        self.assertEqual(storage.get_token(request), 'token')
+        request.COOKIES[storage.name] = 'token'
+        self.assertIsNone(storage.get_token(request))
+
+    def test_signed_cookie_token_requires_response(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SignedCookieCartTokenStorage().set_token(
+                RequestFactory().get('/'), None, 'token')
+
+
+class CartMiddlewareTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=10, size='M', color='red')
+        self.middleware = CartMiddleware()
+        self.cart_app = shop_app.cart_app
+
+    def tearDown(self):
+        dispatcher.flush()
+
+    def get_request(self, user=None):
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+        request.user = user or AnonymousUser()
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        return request
+
+    def get_session_token(self, request):
+        return request.session.get(self.cart_app.cart_session_key)
+
+    def test_cart_is_lazy_and_memoized(self):
+        cart = Cart.objects.create()
+        request = self.get_request()
+        request.session[self.cart_app.cart_session_key] = cart.token
+        with self.assertNumQueries(1):
+            self.assertEqual(request.cart.pk, cart.pk)
+            self.assertIs(self.cart_app.get_cart_for_request(request),
+                          request.cart._wrapped)
+
+    def test_not_written_cart_token_is_not_stored(self):
+        request = self.get_request()
+        self.assertIsNone(request.cart.pk)
+        self.middleware.process_response(request, HttpResponse())
+        self.assertIsNone(self.get_session_token(request))
+        self.assertFalse(Cart.objects.exists())
+
+    def test_written_cart_token_is_stored_on_response(self):
+        request = self.get_request()
+        request.cart.add(self.variant, 1)
+        self.assertIsNone(self.get_session_token(request))
+        self.middleware.process_response(request, HttpResponse())
+        self.assertEqual(self.get_session_token(request), request.cart.token)
+
+    def test_cart_is_reloaded_on_user_change(self):
+        request = self.get_request()
+        anonymous = request.cart._wrapped
+        request.user = User.objects.create(username='user')
+        cart = self.cart_app.get_cart_for_request(request)
+        self.assertIsNot(cart, anonymous)
+        self.assertEqual(cart.user, request.user)
+
+
+class CartExpirationTest(TestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variant = Variant.objects.create(
+            product=product, stock_level=10, size='M', color='red')
+        self.carts = [Cart.objects.create() for i in range(3)]
+        for cart in self.carts:
+            cart.add(self.variant, 1)
+        self.before = timezone.now() + datetime.timedelta(seconds=1)
+
+    def test_expire_carts_command(self):
+        Cart.objects.filter(pk=self.carts[0].pk).update(
+            date_update=timezone.now() - datetime.timedelta(days=8))
+        call_command('cleancarts', stdout=StringIO())
+        self.assertEqual(sorted(Cart.objects.values_list('pk', flat=True)),
+                         [cart.pk for cart in self.carts[1:]])
+
+    def test_carts_updated_after_selection_are_not_deleted(self):
+        expired = Cart.objects.expired(anonymous_before=self.before)
+        pks = list(expired.values_list('pk', flat=True))
+        # cart is changed concurrently after its pk was selected
+        Cart.objects.filter(pk=self.carts[0].pk).update(
+            date_update=self.before + datetime.timedelta(seconds=1))
+
+        self.assertEqual(Cart.objects.delete_by_pk(pks, carts=expired), 2)
+        cart = Cart.objects.get()
+        self.assertEqual(cart.pk, self.carts[0].pk)
+        self.assertEqual(cart.lines.get().quantity, 1)
+
+    def test_delete_by_pk_deletes_lines_and_keeps_orders(self):
+        order = Order.objects.create(cart=self.carts[0])
+        pks = [cart.pk for cart in self.carts[:2]]
+        self.assertEqual(Cart.objects.delete_by_pk(pks), 2)
+        self.assertEqual(list(Cart.objects.values_list('pk', flat=True)),
+                         [self.carts[2].pk])
+        self.assertEqual(CartLine.objects.count(), 1)
+        self.assertIsNone(Order.objects.get(pk=order.pk).cart_id)
+
+
+@override_settings(SATCHLESS_CART_SIGNALS_DISPATCH='commit')
+class CartChangesDispatchTest(TransactionTestCase):
+    def setUp(self):
+        product = Product.objects.create(name='product', price=10)
+        self.variants = [
+            Variant.objects.create(product=product, stock_level=10,
+                                   size='M', color='red')
+            for i in range(2)]
+        self.cart = Cart.objects.create()
+        self.sent = []
+        signals.cart_line_changed.connect(self.receiver)
+        signals.cart_lines_changed.connect(self.receiver)
+
+    def tearDown(self):
+        signals.cart_line_changed.disconnect(self.receiver)
+        signals.cart_lines_changed.disconnect(self.receiver)
+        dispatcher.flush()
+
+    def receiver(self, sender, cart=None, cart_line=None, cart_lines=None,
+                 **kwargs):
+        lines = [cart_line] if cart_line else cart_lines
+        self.sent.append(sorted(line.variant_id for line in lines))
+
+    def test_committed_changes_are_sent_on_flush(self):
+        dispatcher.begin()
+        with transaction.atomic():
+            self.cart.add(self.variants[0], 1)
+            self.cart.add(self.variants[1], 1)
+            self.cart.add(self.variants[0], 1)
+        self.assertEqual(self.sent, [])
+        dispatcher.flush()
+        self.assertEqual(self.sent, [sorted(v.pk for v in self.variants)])
+
+    def test_rolled_back_changes_are_not_sent(self):
+        dispatcher.begin()
+        try:
+            with transaction.atomic():
+                self.cart.add(self.variants[0], 1)
+                raise ValueError()
+        except ValueError:
+            pass
+        dispatcher.flush()
+        self.assertEqual(self.cart.lines.count(), 0)
+        self.assertEqual(self.sent, [])
+
+    def test_rolled_back_savepoint_changes_are_not_sent(self):
+        with transaction.atomic():
+            self.cart.add(self.variants[0], 1)
+            try:
+                with transaction.atomic():
+                    self.cart.add(self.variants[1], 1)
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertEqual(self.sent, [])
+        self.assertEqual(self.sent, [[self.variants[0].pk]])
+
+    def test_changes_of_cart_instances_are_coalesced(self):
+        dispatcher.begin()
+        self.cart.add(self.variants[0], 1)
+        Cart.objects.get(pk=self.cart.pk).add(self.variants[1], 1)
+        dispatcher.flush()
+        self.assertEqual(self.sent, [sorted(v.pk for v in self.variants)])
+
+    def test_worker_reloads_carts(self):
+        self.cart.add(self.variants[0], 2)
+        self.cart.add(self.variants[1], 1)
+        self.cart.add(self.variants[1], -1)
+        events = dispatcher.load_events([(Cart, self.cart.pk, [
+            (self.variants[0].pk, get_data_key(None)),
+            (self.variants[1].pk, get_data_key(None))])])
+
+        [(cart, lines)] = events
+        self.assertIsNot(cart, self.cart)
+        self.assertEqual(cart.pk, self.cart.pk)
+        self.assertEqual([(line.variant_id, line.quantity) for line in lines],
+                         [(self.variants[0].pk, 2), (self.variants[1].pk, 0)])
+        self.assertTrue(all(line.cart is cart for line in lines))
@@ -23,6 +23,19 @@ class CheckoutApp(app.MultiStepCheckoutApp):
         shop_app.order_app.DeliveryGroup,
         form=forms.ShippingForm, fields=forms.ShippingForm._meta.fields)
 
+    def get_order_from_cart(self, request, cart):
+        order = super(CheckoutApp, self).get_order_from_cart(request, cart)
+        # renew expired reservation of order not changed since last
+        # partitioning
+        if not order.is_stock_reserved():
+            order.reserve_stock()
+        return order
+
+    def partition_cart(self, cart, order, **pricing_context):
+        super(CheckoutApp, self).partition_cart(cart, order, **pricing_context)
+        # hold stock for (changed) order lines until checkout is finished
+        order.reserve_stock()
+
     # Views methods section
     # ---------------------
     def get_urls(self):
@@ -0,0 +1,45 @@
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory, TestCase
+from shop.core.app import shop_app
+from shop.orders.models import DeliveryGroup
+from shop.orders.tests import OrderTestMixin
+
+
+class CheckoutContextTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+        self.other_group = DeliveryGroup.objects.create(
+            order=self.order, shipping_address_required=True)
+        self.checkout_app = shop_app.checkout_app
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        self.checkout = self.checkout_app.get_checkout_context(
+            request, self.order.token)
+
+    def test_filter_groups(self):
+        groups = self.checkout.filter_groups(shipping_address_required=True)
+        self.assertEqual([group.pk for group in groups],
+                         [self.other_group.pk])
+        self.assertEqual(len(self.checkout.filter_groups()), 2)
+
+    def test_formset_of_loaded_groups_makes_no_queries(self):
+        groups = self.checkout.filter_groups()
+        with self.assertNumQueries(0):
+            formset = self.checkout_app.ShippingFormSet(queryset=groups)
+            self.assertEqual([form.instance for form in formset.forms],
+                             groups)
+
+    def test_bound_formset_saves_loaded_groups(self):
+        group = self.checkout.filter_groups(shipping_address_required=True)[0]
+        formset = self.checkout_app.ShippingFormSet(queryset=[group], data={
+            'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1',
+            'form-0-id': str(group.pk), 'form-0-shipping_first_name': 'John',
+            'form-0-shipping_last_name': 'Doe',
+            'form-0-shipping_street_address_1': 'Main St 1',
+            'form-0-shipping_city': 'Warsaw',
+            'form-0-shipping_postal_code': '00-001',
+            'form-0-shipping_country': 'PL'})
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(DeliveryGroup.objects.get(
+            pk=group.pk).shipping_first_name, 'John')
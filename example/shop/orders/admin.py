@@ -1,7 +1,25 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils.translation import ugettext_lazy as _
 from . import models
 
 
-admin.site.register(models.Order)
+class OrderAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        """Change status of existing order by set_status only."""
+        if not change or 'status' not in form.changed_data:
+            return super(OrderAdmin, self).save_model(request, obj, form,
+                                                      change)
+
+        # other changed fields are saved by set_status
+        new_status, obj.status = obj.status, form.initial['status']
+        if obj.set_status(new_status):
+            self.message_user(request, _(
+                'Order status was not changed from "%(old)s" to "%(new)s",'
+                ' transition is not allowed or status was changed'
+                ' concurrently.') % {'old': obj.status, 'new': new_status},
+                level=messages.ERROR)
+
+
+admin.site.register(models.Order, OrderAdmin)
 admin.site.register(models.DeliveryGroup)
 admin.site.register(models.OrderLine)
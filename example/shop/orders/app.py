@@ -7,6 +7,7 @@ class OrderApp(app.OrderApp):
     Order = models.Order
     DeliveryGroup = models.DeliveryGroup
     OrderLine = models.OrderLine
+    ArchivedOrder = models.ArchivedOrder
 
     # Views methods section
     # ---------------------
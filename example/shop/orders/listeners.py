@@ -1,11 +1,16 @@
 from shopkit.cart import signals
 
 
-def cart_line_changed_listener(sender, cart=None, cart_line=None, **kwargs):
-    # clean all in-checkout stage orders on cart changed
-    for order in cart.orders.filter(status=cart.orders.model.SC.CHECKOUT):
-        order.groups.all().delete()
+def cart_line_changed_listener(sender, cart=None, **kwargs):
+    # mark all in-checkout stage orders as outdated on cart changed, they
+    # will be re-partitioned by checkout_app.get_order_from_cart
+    if not cart.pk:
+        return  # not materialized cart has no orders
+    Order = cart.orders.model
+    cart.orders.filter(status=Order.SC.CHECKOUT).update(
+        cart_fingerprint=Order.OUTDATED)
 
 
 def start_listening():
     signals.cart_line_changed.connect(cart_line_changed_listener)
+    signals.cart_lines_changed.connect(cart_line_changed_listener)
@@ -0,0 +1,7 @@
+from shopkit.order.management.commands import archiveorders
+from ...models import ArchivedOrder, Order
+
+
+class Command(archiveorders.Command):
+    model = Order
+    archive_model = ArchivedOrder
@@ -0,0 +1,6 @@
+from shopkit.order.management.commands import exportorders
+from ...models import Order
+
+
+class Command(exportorders.Command):
+    model = Order
@@ -0,0 +1,6 @@
+from shopkit.order.management.commands import migratestatushistory
+from ...models import Order
+
+
+class Command(migratestatushistory.Command):
+    model = Order
@@ -0,0 +1,6 @@
+from shopkit.order.management.commands import updateordertotals
+from ...models import Order
+
+
+class Command(updateordertotals.Command):
+    model = Order
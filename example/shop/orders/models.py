@@ -1,26 +1,34 @@
 from shopkit.order import models
 from shopkit.contrib.stock.singlestore import models as stockmodels
+from shopkit.contrib.stock.reservation import models as reservemodels
 
 
-class Order(stockmodels.OrderStockLevelMixin, models.Order):
+class Order(reservemodels.OrderStockReservationMixin, models.Order):
+    SC = models.Order.SC
+
+    status_transitions = {
+        SC.CHECKOUT: (SC.PAYMENT_PENDING, SC.CANCELLED,),
+        SC.PAYMENT_PENDING: (SC.PAYMENT_COMPLETE, SC.PAYMENT_FAILED,
+                             SC.CANCELLED,),
+        SC.PAYMENT_FAILED: (SC.CHECKOUT, SC.CANCELLED,),
+        SC.PAYMENT_COMPLETE: (SC.DELIVERED, SC.CANCELLED,),
+    }
+
+    class Meta(models.Order.Meta):
+        pass
 
     def set_status(self, new_status, failure=False):
         """Order new status setting extended handler."""
 
         old_status, SC = self.status, self.SC
 
-        # check possibility of new_status value setting
-        if old_status == new_status:
-            failure = True
-        if old_status == SC.PAYMENT_PENDING and new_status == SC.CHECKOUT:
-            failure = True
-
-        # save new_status and call signal
-        super(Order, self).set_status(new_status, failure=failure)
-        if not failure:
+        # save new_status and call signal (possibility of new_status value
+        # setting is checked by status_transitions)
+        failure = super(Order, self).set_status(new_status, failure=failure)
+        if failure:
             return failure
 
-        # do some on change status staff
+        # do some on change status staff (only once, concurrent calls fail)
         if new_status == SC.PAYMENT_COMPLETE and old_status == SC.PAYMENT_PENDING:
             self.stock_handler(action='take')
         if new_status == SC.CANCELLED and old_status == SC.PAYMENT_COMPLETE:
@@ -32,9 +40,21 @@ class Order(stockmodels.OrderStockLevelMixin, models.Order):
         return failure
 
 
+class OrderStatusEvent(models.OrderStatusEvent):
+    pass
+
+
+class ArchivedOrder(models.ArchivedOrder):
+    pass
+
+
 class DeliveryGroup(models.DeliveryGroup):
     pass
 
 
 class OrderLine(stockmodels.OrderLineStockLevelMixin, models.OrderLine):
     pass
+
+
+class StockReservation(reservemodels.StockReservation):
+    pass
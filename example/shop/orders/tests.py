@@ -0,0 +1,522 @@
+import csv
+import datetime
+import json
+import warnings
+from decimal import Decimal
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+from shop.carts.models import Cart
+from shop.core.app import shop_app
+from shop.products.models import Product, Variant
+from .admin import OrderAdmin
+from .models import (ArchivedOrder, DeliveryGroup, Order, OrderLine,
+                     OrderStatusEvent, StockReservation)
+
+
+class OrderTestMixin(object):
+    def create_variants(self, count, stock=10):
+        product = Product.objects.create(name='product', price=10)
+        return [Variant.objects.create(product=product, stock_level=stock,
+                                       size='M', color='red')
+                for i in range(count)]
+
+    def create_order(self, quantities=(2, 3,), stock=10, variants=None,
+                     **kwargs):
+        variants = variants or self.create_variants(len(quantities), stock)
+        order = Order.objects.create(**kwargs)
+        group = DeliveryGroup.objects.create(order=order, delivery_price=5)
+        for variant, quantity in zip(variants, quantities):
+            OrderLine.objects.bulk_create([OrderLine(
+                delivery_group=group, variant=variant, name='line',
+                quantity=quantity, unit_price_net=10,
+                unit_price_gross=Decimal('12.30'))])
+        return Order.objects.get(pk=order.pk)
+
+
+class OrderTotalsTest(OrderTestMixin, TestCase):
+    def test_not_computed_totals_fall_back_to_total(self):
+        order = self.create_order()
+        Order.objects.filter(pk=order.pk).update(total_net=None,
+                                                 total_gross=None)
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.get_cached_total(), order.get_total())
+        self.assertEqual(order.get_cached_total().gross, Decimal('66.5'))
+
+    def test_update_totals_command(self):
+        order = self.create_order()
+        Order.objects.filter(pk=order.pk).update(total_net=None,
+                                                 total_gross=None)
+        call_command('updateordertotals', stdout=StringIO())
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.total_gross, Decimal('66.5'))
+        self.assertEqual(order.item_count, 5)
+        self.assertEqual(order.groups.get().total_gross, Decimal('66.5'))
+
+    def test_line_and_group_changes_update_totals(self):
+        order = self.create_order()
+        order.update_totals()
+
+        line = OrderLine.objects.order_by('pk')[0]
+        line.quantity = 4
+        line.save()
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.item_count, 7)
+        self.assertEqual(order.total_net, Decimal('75'))
+
+        group = order.groups.get()
+        group.delivery_price = 10
+        group.save()
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.total_net, Decimal('80'))
+        self.assertEqual(order.get_cached_total(), order.get_total())
+
+        OrderLine.objects.order_by('pk')[0].delete()
+        order = Order.objects.get(pk=order.pk)
+        self.assertEqual(order.item_count, 3)
+        self.assertEqual(order.get_cached_total(), order.get_total())
+
+
+class OrderOutdatedTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.cart = Cart.objects.create()
+
+    def test_legacy_order_is_not_outdated(self):
+        order = self.create_order(cart=self.cart)
+        self.assertEqual(order.cart_fingerprint, '')
+        self.assertFalse(order.is_outdated())
+
+    def test_only_checkout_order_is_outdated(self):
+        order = self.create_order(cart=self.cart,
+                                  cart_fingerprint=Order.OUTDATED)
+        self.assertTrue(order.is_outdated())
+        Order.objects.filter(pk=order.pk).update(
+            status=Order.SC.PAYMENT_PENDING)
+        order = Order.objects.get(pk=order.pk)
+        self.assertFalse(order.is_outdated())
+        self.assertTrue(shop_app.checkout_app.check_order(
+            order, check_quantity=False))
+
+    @override_settings(SATCHLESS_CART_SIGNALS_DISPATCH='sync')
+    def test_cart_change_marks_checkout_order_outdated(self):
+        order = self.create_order(cart=self.cart)
+        self.cart.add(order.get_lines()[0].variant, 1)
+        self.assertTrue(Order.objects.get(pk=order.pk).is_outdated())
+
+
+class OrderRepartitionTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.variant = self.create_variants(1, stock=10)[0]
+        self.cart = Cart.objects.create()
+        self.cart.add(self.variant, 3)
+
+    def get_order(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        return shop_app.checkout_app.get_order_from_cart(None, cart)
+
+    def test_unchanged_cart_is_not_repartitioned(self):
+        order = self.get_order()
+        line = order.get_lines()[0]
+        order = self.get_order()
+        self.assertEqual(order.get_lines()[0].pk, line.pk)
+        self.assertEqual(order.get_lines()[0].date_update, line.date_update)
+
+    def test_price_change_repartitions_order(self):
+        order = self.get_order()
+        self.assertEqual(order.get_lines()[0].unit_price_net, 10)
+        Product.objects.update(price=20)
+
+        order = self.get_order()
+        self.assertEqual(order.get_lines()[0].unit_price_net, 20)
+        self.assertEqual(Order.objects.get(pk=order.pk).total_net,
+                         Decimal('60'))
+
+    def test_fixed_order_is_repartitioned(self):
+        order = self.get_order()
+        Variant.objects.update(stock_level=2)
+        order.release_stock()
+        order.fix_lines_quantities()
+        self.assertEqual(Order.objects.get(pk=order.pk).cart_fingerprint, '')
+
+        order = self.get_order()
+        self.assertEqual(order.cart_fingerprint,
+                         Cart.objects.get(pk=self.cart.pk).get_fingerprint())
+
+
+class CartPartitionTest(OrderTestMixin, TestCase):
+    def partition(self, cart, order):
+        cart = Cart.objects.get(pk=cart.pk)
+        with CaptureQueriesContext(connection) as queries:
+            shop_app.checkout_app.partition_cart(cart, order)
+        return len(queries)
+
+    def create_cart(self, variants):
+        cart = Cart.objects.create()
+        cart.add_many([(variant, 1, None) for variant in variants])
+        return cart, Order.objects.create(cart=cart)
+
+    def test_groups_and_lines_are_reused(self):
+        variants = self.create_variants(3)
+        cart, order = self.create_cart(variants)
+        self.partition(cart, order)
+        group = order.groups.get()
+        kept = group.lines.get(variant=variants[0])
+
+        cart.add(variants[1], 5, replace=True)
+        cart.add(variants[2], 0, replace=True)
+        self.partition(cart, order)
+        self.assertEqual(order.groups.get().pk, group.pk)
+        self.assertEqual(group.lines.get(variant=variants[0]).pk, kept.pk)
+        self.assertEqual(sorted(group.lines.values_list(
+            'variant_id', 'quantity')), [(variants[0].pk, 1),
+                                         (variants[1].pk, 5)])
+
+    def test_query_count_does_not_depend_on_lines_count(self):
+        counts = [self.partition(*self.create_cart(self.create_variants(n)))
+                  for n in (1, 4)]
+        self.assertEqual(counts[0], counts[1])
+
+
+class OrderHistoryPageTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        date = timezone.now()
+        self.orders = [Order.objects.create(user=self.user) for i in range(5)]
+        # two orders share date of last status change
+        for i, order in enumerate(self.orders):
+            Order.objects.filter(pk=order.pk).update(
+                date_last_status_change=date - datetime.timedelta(
+                    minutes=min(i, 3)))
+        Order.objects.create(user=User.objects.create(username='other'))
+        self.order_app = shop_app.order_app
+        self.order_app.orders_per_page = 2
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def tearDown(self):
+        del self.order_app.orders_per_page
+
+    def get_page(self, **kwargs):
+        orders, previous, next = self.order_app.get_orders_page(
+            self.request, **kwargs)
+        return [order.pk for order in orders], previous, next
+
+    def test_pages_are_walked_both_ways(self):
+        expected = [order.pk for order in Order.objects.filter(
+            user=self.user).order_by('-date_last_status_change', '-id')]
+        pages, cursor = [], None
+        while True:
+            pks, previous, cursor = self.get_page(after=cursor)
+            self.assertEqual(previous is None, not pages)
+            pages.append(pks)
+            if cursor is None:
+                break
+        self.assertEqual(pages, [expected[:2], expected[2:4], expected[4:]])
+
+        pks, previous, next = self.get_page(before=previous)
+        self.assertEqual(pks, expected[2:4])
+        pks, previous, next = self.get_page(before=previous)
+        self.assertEqual(pks, expected[:2])
+        self.assertIsNone(previous)
+        self.assertIsNotNone(next)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(Http404):
+            self.get_page(after='invalid')
+
+
+class ExportOrdersTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.orders = [self.create_order(), self.create_order(quantities=())]
+        DeliveryGroup.objects.filter(order=self.orders[1]).delete()
+        self.orders.append(self.create_order(quantities=(1,),
+                                             status=Order.SC.DELIVERED))
+
+    def export(self, *args, **options):
+        output = StringIO()
+        call_command('exportorders', *args, stdout=output, chunk_size=2,
+                     buffer_size=10, **options)
+        return output.getvalue()
+
+    def test_csv_has_row_per_line(self):
+        rows = list(csv.DictReader(StringIO(self.export())))
+        self.assertEqual([(int(row['order_id']), row['line_quantity'])
+                          for row in rows],
+                         [(self.orders[0].pk, '2'), (self.orders[0].pk, '3'),
+                          (self.orders[1].pk, ''), (self.orders[2].pk, '1')])
+        self.assertEqual(rows[0]['line_unit_price_gross'], '12.3000')
+
+    def test_jsonl_has_order_per_line(self):
+        orders = [json.loads(line) for line in
+                  self.export(format='jsonl').splitlines()]
+        self.assertEqual([order['id'] for order in orders],
+                         [order.pk for order in self.orders])
+        self.assertEqual([len(group['lines']) for group
+                          in orders[0]['groups']], [2])
+        self.assertEqual(orders[1]['groups'], [])
+
+    def test_filters(self):
+        orders = self.export('--status', Order.SC.DELIVERED, format='jsonl')
+        self.assertEqual([json.loads(line)['id']
+                          for line in orders.splitlines()],
+                         [self.orders[2].pk])
+        self.assertEqual(self.export(format='jsonl', until='2000-01-01'), '')
+        with self.assertRaises(CommandError):
+            self.export(since='yesterday')
+
+
+class OrderStatusTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order()
+        self.admin = OrderAdmin(Order, admin.site)
+
+    def admin_save(self, order, **data):
+        request = RequestFactory().post('/')
+        request.user = User(is_superuser=True, is_staff=True)
+        request._messages = CookieStorage(request)
+        Form = self.admin.get_form(request, order)
+        initial = Form(instance=order).initial
+        form = Form(instance=order, data=dict(initial, **data))
+        self.assertTrue(form.is_valid(), form.errors)
+        self.admin.save_model(request, form.save(commit=False), form, True)
+        return [m.message for m in request._messages]
+
+    def test_save_changes_status_by_set_status(self):
+        self.order.status = Order.SC.PAYMENT_PENDING
+        self.order.billing_first_name = 'John'
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.order.save()
+        self.assertEqual(len(caught), 1)
+
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.status, Order.SC.PAYMENT_PENDING)
+        self.assertEqual(order.billing_first_name, 'John')
+        self.assertTrue(order.status_events.get().success)
+
+    def test_save_does_not_set_not_allowed_status(self):
+        self.order.status = Order.SC.DELIVERED
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.order.save()
+        self.assertEqual(self.order.status, Order.SC.CHECKOUT)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status,
+                         Order.SC.CHECKOUT)
+        self.assertFalse(self.order.status_events.get().success)
+
+    def test_set_status_saves_other_fields(self):
+        self.order.payment_type_name = 'Stripe.com'
+        self.assertFalse(self.order.set_status(Order.SC.PAYMENT_PENDING))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).payment_type_name,
+                         'Stripe.com')
+
+    def test_stale_order_status_conflict(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        self.assertFalse(self.order.set_status(Order.SC.PAYMENT_PENDING))
+        self.assertFalse(self.order.status_conflict)
+
+        self.assertTrue(stale.set_status(Order.SC.CANCELLED))
+        self.assertTrue(stale.status_conflict)
+        # stale instance is reloaded with concurrently set status
+        self.assertEqual(stale.status, Order.SC.PAYMENT_PENDING)
+        self.assertEqual(stale.version, self.order.version)
+        stale.save()
+
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.status, Order.SC.PAYMENT_PENDING)
+        self.assertEqual(list(order.status_events.order_by('pk').values_list(
+            'new_status', 'success')), [(Order.SC.PAYMENT_PENDING, True),
+                                        (Order.SC.CANCELLED, False)])
+
+    def test_admin_changes_status_by_set_status(self):
+        version = self.order.version
+        self.assertEqual(self.admin_save(
+            self.order, status=Order.SC.PAYMENT_PENDING,
+            billing_first_name='John'), [])
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.status, Order.SC.PAYMENT_PENDING)
+        self.assertEqual(order.billing_first_name, 'John')
+        self.assertEqual(order.version, version + 1)
+        self.assertTrue(order.status_events.get().success)
+
+    def test_admin_reports_not_allowed_status(self):
+        messages = self.admin_save(self.order, status=Order.SC.DELIVERED,
+                                   billing_first_name='John')
+        self.assertEqual(len(messages), 1)
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual(order.status, Order.SC.CHECKOUT)
+        self.assertEqual(order.billing_first_name, 'John')
+        self.assertFalse(order.status_events.get().success)
+
+
+class OrderStockHandlerTest(OrderTestMixin, TestCase):
+    def get_stock_levels(self, order):
+        return sorted(Variant.objects.filter(
+            orderline__delivery_group__order=order).values_list(
+                'stock_level', flat=True))
+
+    def test_take_and_free_stock_once(self):
+        order = self.create_order(quantities=(2, 3,), stock=10)
+        stale = Order.objects.get(pk=order.pk)
+
+        self.assertTrue(order.stock_handler(action='take'))
+        self.assertEqual(self.get_stock_levels(order), [7, 8])
+        self.assertEqual(sorted(OrderLine.objects.values_list(
+            'stock_level_taken', flat=True)), [2, 3])
+        # concurrent (stale) take does not take stock twice
+        self.assertTrue(stale.stock_handler(action='take'))
+        self.assertEqual(self.get_stock_levels(order), [7, 8])
+
+        self.assertTrue(order.stock_handler(action='free'))
+        self.assertEqual(self.get_stock_levels(order), [10, 10])
+        self.assertTrue(stale.stock_handler(action='free'))
+        self.assertEqual(self.get_stock_levels(order), [10, 10])
+        self.assertEqual(Order.objects.get(pk=order.pk).stock_state,
+                         Order.STOCK_FREE)
+
+    def test_shortfall_rolls_back_take(self):
+        order = self.create_order(quantities=(2, 3,), stock=2)
+        self.assertFalse(order.stock_handler(action='take'))
+        self.assertEqual(list(order.stock_shortfalls.values()), [1])
+        self.assertEqual(self.get_stock_levels(order), [2, 2])
+        self.assertEqual(Order.objects.get(pk=order.pk).stock_state,
+                         Order.STOCK_FREE)
+
+        self.assertTrue(order.stock_handler(action='take',
+                                            check_quantity=False))
+        self.assertEqual(self.get_stock_levels(order), [0, 0])
+        self.assertEqual(sorted(OrderLine.objects.values_list(
+            'stock_level_taken', flat=True)), [2, 2])
+
+
+class OrderStockReservationTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.variants = self.create_variants(1, stock=5)
+        self.reserved = self.create_order(quantities=(3,),
+                                          variants=self.variants)
+        self.assertTrue(self.reserved.reserve_stock())
+
+    def test_other_order_can_not_take_reserved_stock(self):
+        order = self.create_order(quantities=(3,), variants=self.variants)
+        self.assertFalse(order.stock_handler(action='take'))
+        self.assertEqual(list(order.stock_shortfalls.values()), [1])
+        self.assertEqual(Variant.objects.get().stock_level, 5)
+
+        self.assertTrue(self.reserved.stock_handler(action='take'))
+        self.assertEqual(Variant.objects.get().stock_level, 2)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(Order.objects.get(
+            pk=self.reserved.pk).is_stock_reserved())
+
+    def test_reservation_without_holds_is_recorded(self):
+        # all remaining stock is held by other orders
+        order = self.create_order(quantities=(2,), variants=self.variants)
+        self.assertTrue(order.reserve_stock())
+        order = self.create_order(quantities=(1,), variants=self.variants)
+        self.assertFalse(order.reserve_stock())
+        self.assertFalse(StockReservation.objects.filter(
+            order_line__delivery_group__order=order).exists())
+        self.assertTrue(Order.objects.get(pk=order.pk).is_stock_reserved())
+
+        order.release_stock()
+        self.assertFalse(Order.objects.get(pk=order.pk).is_stock_reserved())
+
+    def test_release_expired_reservations_command(self):
+        StockReservation.objects.update(
+            date_expire=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertFalse(Order.objects.get(
+            pk=self.reserved.pk).stock_reserved_until is None)
+        call_command('releasestock', stdout=StringIO())
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class ArchiveOrdersTest(OrderTestMixin, TestCase):
+    def setUp(self):
+        self.order = self.create_order(status=Order.SC.DELIVERED)
+        self.order.update_totals()
+        self.order.status_events.create(old_status=Order.SC.CHECKOUT,
+                                        new_status=Order.SC.DELIVERED)
+        Order.objects.update(date_last_status_change=(
+            timezone.now() - datetime.timedelta(days=400)))
+
+    def archive(self):
+        output = StringIO()
+        call_command('archiveorders', stdout=output)
+        return output.getvalue()
+
+    def test_archived_order_is_restored(self):
+        self.assertIn('Archived 1 orders.', self.archive())
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderLine.objects.exists())
+
+        archived = ArchivedOrder.objects.get()
+        self.assertEqual(archived.token, self.order.token)
+        with self.assertNumQueries(0):
+            order, groups = archived.get_order(Order)
+        self.assertEqual(order.pk, self.order.pk)
+        self.assertEqual(order.get_cached_total().gross, Decimal('66.5'))
+        self.assertEqual(len(groups), 1)
+        group, lines = groups[0]
+        self.assertEqual(group.get_cached_total().gross, Decimal('66.5'))
+        self.assertEqual(sorted(line.quantity for line in lines), [2, 3])
+
+    def test_details_view_renders_archived_order(self):
+        self.archive()
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        response = shop_app.order_app.details(request, self.order.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count(b'<tr>'), 5)
+
+    def test_order_with_other_related_objects_is_skipped(self):
+        self.order.reserve_stock()
+        self.assertTrue(StockReservation.objects.exists())
+        self.assertIn('Skipped 1 orders', self.archive())
+        self.assertTrue(Order.objects.filter(pk=self.order.pk).exists())
+        self.assertTrue(StockReservation.objects.exists())
+        self.assertFalse(ArchivedOrder.objects.exists())
+
+    def test_recent_order_is_not_archived(self):
+        Order.objects.update(date_last_status_change=timezone.now())
+        self.assertIn('Archived 0 orders.', self.archive())
+        self.assertTrue(Order.objects.exists())
+
+
+class MigrateStatusHistoryTest(OrderTestMixin, TestCase):
+    history = ('\n2012-01-02 10:00:00+00:00 #1 abc: checkout -> '
+               'payment-pending (successfull)'
+               '\nbroken line'
+               '\n2012-01-03 10:00:00+00:00 #1 abc: payment-pending -> '
+               'payment-complete (failure)')
+
+    def migrate(self, **options):
+        output = StringIO()
+        call_command('migratestatushistory', stdout=output, **options)
+        return output.getvalue()
+
+    def test_history_is_moved_to_events(self):
+        orders = [self.create_order() for i in range(3)]
+        Order.objects.update(status_history=self.history)
+        self.assertIn('3 orders (3 lines left not parsed)',
+                      self.migrate(batch_size=2))
+
+        for order in orders:
+            self.assertEqual(list(order.status_events.order_by(
+                'date_create').values_list('new_status', 'success')),
+                [(Order.SC.PAYMENT_PENDING, True),
+                 (Order.SC.PAYMENT_COMPLETE, False)])
+        # not parsed lines are kept
+        self.assertEqual(set(Order.objects.values_list('status_history',
+                                                       flat=True)),
+                         {'broken line'})
+
+        # orders with lines left are processed again by next run only
+        self.assertIn('3 orders (3 lines left not parsed)', self.migrate())
+        self.assertEqual(OrderStatusEvent.objects.count(), 6)
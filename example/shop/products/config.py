@@ -7,4 +7,5 @@ class ProductsConfig(AppConfig):
     verbose_name = u'Products'
 
     def ready(self):
-        pass
+        from . import listeners
+        listeners.start_listening()
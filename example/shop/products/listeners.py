@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from shopkit.product.pricing import bump_pricing_version
+from . import models
+
+
+def start_listening():
+    # all models affecting prices of variants, see Variant.get_price
+    for model in (models.Product, models.Variant, models.Discount,
+                  models.Tax, models.PriceQtyOverride,):
+        for signal in (post_save, post_delete):
+            signal.connect(bump_pricing_version, sender=model,
+                           dispatch_uid='bump-pricing-version')
@@ -7,7 +7,7 @@ from django_prices.models import PriceField
 from prices import FractionalDiscount, LinearTax
 from shopkit.product import models as productmodels
 from shopkit.contrib.product.category import models as catmodels
-from shopkit.contrib.stock.singlestore import models as stockmodels
+from shopkit.contrib.stock.reservation import models as stockmodels
 
 
 class Category(catmodels.Category):
@@ -109,15 +109,14 @@ class Product(catmodels.CategorizedProductMixin,
         return self.name
 
     def get_product_base_price(self, quantity):
-        overrides = self.qty_price_overrides.all()
-        overrides = overrides.filter(min_qty__lte=quantity).order_by('-min_qty')
-        try:
-            return overrides[0].price
-        except Exception:
-            return self.price
+        # filter in python to use prefetched overrides (cart lines snapshot)
+        overrides = [i for i in self.qty_price_overrides.all()
+                     if i.min_qty <= quantity]
+        overrides.sort(key=lambda i: i.min_qty, reverse=True)
+        return overrides[0].price if overrides else self.price
 
 
-class Variant(stockmodels.VariantStockLevelMixin,
+class Variant(stockmodels.VariantStockReservationMixin,
               productmodels.Variant):
     price_offset = PriceField(_('unit price offset'), currency='EUR',
                               default=0, max_digits=12, decimal_places=4)
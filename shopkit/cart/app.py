@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
+import hashlib
+from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.http import require_GET
 from django.contrib import messages
 from django.conf.urls import url
+from django.utils import six
+from django.utils.module_loading import import_string
+from prices import Price
 from ..core.app import ShopKitApp
+from .forms import CartLineFormSet
 
 
 class CartApp(ShopKitApp):
@@ -16,12 +25,23 @@ class CartApp(ShopKitApp):
     Cart = None
     CartLineAddForm = None
     CartLineReplaceForm = None
+    CartLineFormSet = CartLineFormSet
 
     cart_view_templates = [
         'shopkit/cart/view.html'
     ]
 
     def __init__(self, **kwargs):
+        storage = kwargs.pop(
+            'cart_token_storage', getattr(
+                settings, 'SATCHLESS_CART_TOKEN_STORAGE',
+                'shopkit.cart.tokens.SessionCartTokenStorage'))
+        if isinstance(storage, six.string_types):
+            storage = import_string(storage)
+        if isinstance(storage, type):
+            storage = storage(name=self.cart_session_key)
+        self.cart_token_storage = storage
+
         super(CartApp, self).__init__(**kwargs)
         assert self.Cart, ('You need to subclass CartApp and provide Cart.')
         assert self.CartLineAddForm, (
@@ -30,37 +50,69 @@ class CartApp(ShopKitApp):
             'You need to subclass CartApp and provide CartLineReplaceForm.')
 
     def get_cart_for_request(self, request):
-        token = request.session.get(self.cart_session_key, None)
+        """
+        Return cart for request, memoized on request object, so all apps
+        (and request.cart, see CartMiddleware) share one cart instance with
+        its lines snapshot within request. Cart is reloaded if request's
+        user was changed (e.g. on login).
+        """
         user = request.user if request.user.is_authenticated else None
+        cached = getattr(request, '_shopkit_cart', None)
+        if cached is None or cached[0] != (user and user.pk):
+            cart = self.load_cart_for_request(request, user=user)
+            request._shopkit_cart = cached = (user and user.pk, cart,)
+        return cached[1]
+
+    def load_cart_for_request(self, request, user=None):
+        """
+        Load cart from db or instantiate new one (without saving it).
+        Anonymous cart's token is stored by cart_token_storage immediately,
+        unless CartMiddleware is used, which stores it only after cart was
+        saved.
+        """
+        token = self.cart_token_storage.get_token(request)
 
         if user:
-            cart = user.carts.first() or self.Cart(user=user)
+            cart = user.carts.first()
+            if cart is None:
+                # not saved user cart keeps its token (see CartStorage)
+                cart = self.Cart(user=user)
+                cart.token = cart.get_storage().load_token(cart) or cart.token
         elif token:
             cart = (self.Cart.objects.filter(token=token).first() or
                     self.Cart(token=token))
         else:
             cart = self.Cart()
-            request.session[self.cart_session_key] = cart.token
+            if not getattr(request, 'cart_token_deferred', False):
+                self.cart_token_storage.set_token(request, None, cart.token)
 
         return cart
 
+    def save_cart_token(self, request, response):
+        """
+        Store token of request's anonymous cart by cart_token_storage if
+        cart was stored during request (called by CartMiddleware on response).
+        """
+        cached = getattr(request, '_shopkit_cart', None)
+        cart = cached and cached[1]
+        if (cart and not cart.user_id and cart.get_storage().exists(cart) and
+                self.cart_token_storage.get_token(request) != cart.token):
+            self.cart_token_storage.set_token(request, response, cart.token)
+        return response
+
     def check_cart(self, cart, check_quantity=True):
         checked = True
         if check_quantity:
             checked = cart.check_lines_quantities()
         return checked
 
-    def get_form_for_cartline(self, request, cart, cart_line):
-        prefix = 'cartline-%i' % cart_line.variant.id
-        initial = {'quantity': cart_line.get_quantity(),}
-        received = '%s-quantity' % prefix in request.POST
-        form = self.CartLineReplaceForm(
-            data=request.POST if received else None, prefix=prefix,
-            cart=cart, variant=cart_line.variant, initial=initial)
-        return form
+    def get_cart_line_formset(self, request, cart):
+        data = request.POST if request.method == 'POST' else None
+        return self.CartLineFormSet(data=data, cart=cart,
+                                    form_class=self.CartLineReplaceForm)
 
-    def on_cartline_form_valid(self, request, form, cart_line):
-        form.save()
+    def on_cart_line_formset_valid(self, request, formset):
+        formset.save()
 
     def on_cart_view(self, cart, request):
         if not self.check_cart(cart):
@@ -68,28 +120,30 @@ class CartApp(ShopKitApp):
                 return JsonResponse({'error': 'fix-cart-lines'}, status=400)
             return self.redirect('fix-cart-lines')
 
-        cart_line_forms, valid = [], False
-        for cart_line in cart:
-            form = self.get_form_for_cartline(request, cart, cart_line)
-            if form.is_valid():
-                self.on_cartline_form_valid(request, form, cart_line)
-                valid = True
-            cart_line_forms.append(form)
+        formset = self.get_cart_line_formset(request, cart)
+        valid = formset.is_valid()
+        if valid:
+            self.on_cart_line_formset_valid(request, formset)
+        cart_line_forms = formset.forms
 
         if request.is_ajax():
+            lines, total = self.get_lines_prices(
+                cart, [form.cart_line for form in cart_line_forms])
             return JsonResponse({
-                'count': len(cart),
-                'price': cart.get_total().gross,
+                'count': cart.line_count,
+                'quantity': cart.total_quantity,
+                'price': total.gross,
                 'currency': cart.get_currency(),
                 'lines': {
                     form.cart_line.variant_id: {
                         'variant_id': form.cart_line.variant_id,
                         'quantity': form.cart_line.get_quantity(),
-                        'unit_price': form.cart_line.get_price_per_item().gross,
-                        'price': form.cart_line.get_total().gross,
+                        'unit_price': price.gross,
+                        'price': line_total.gross,
                         'processed': form.is_bound,
                         'errors': form.errors or None,
-                    } for form in cart_line_forms
+                    } for form, (line, price, line_total)
+                    in zip(cart_line_forms, lines)
                 }
             })
 
@@ -98,12 +152,62 @@ class CartApp(ShopKitApp):
             'cart': cart, 'cart_line_forms': cart_line_forms,
         }
 
+    def get_lines_prices(self, cart, lines):
+        """
+        Return list of (line, price per item, line total) tuples for given
+        cart lines and their total, each line is priced once, so total
+        always agrees with lines prices.
+        """
+        prices = []
+        for line in lines:
+            price = line.get_price_per_item()
+            prices.append((line, price, price * line.get_quantity()))
+        totals = [line_total for line, price, line_total in prices]
+        total = (sum(totals[1:], totals[0]) if totals else
+                 Price(0, currency=cart.get_currency()))
+        return prices, total
+
+    def get_cart_summary_etag(self, cart):
+        """
+        Return ETag of cart summary based on cart's update date and pricing
+        version, which is changed on any price change (see
+        Cart.get_pricing_version), so it is computed without loading and
+        pricing of lines. Not saved carts have no ETag.
+        """
+        if not cart.pk:
+            return None
+        key = '%s:%s:%s' % (cart.token, cart.date_update.isoformat(),
+                            cart.get_pricing_version(),)
+        return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def get_cart_summary(self, cart):
+        """
+        Return JSON serializable summary of cart lines snapshot, lines and
+        total are priced together (see get_lines_prices).
+        """
+        lines, total = self.get_lines_prices(cart, cart.get_lines())
+        return {
+            'count': cart.line_count,
+            'quantity': cart.total_quantity,
+            'price': total.gross,
+            'currency': cart.get_currency(),
+            'lines': {
+                line.variant_id: {
+                    'variant_id': line.variant_id,
+                    'quantity': line.get_quantity(),
+                    'unit_price': price.gross,
+                    'price': line_total.gross,
+                } for line, price, line_total in lines
+            }
+        }
+
     # Views methods section
     # ---------------------
     def get_urls(self):
         return [
             url(r'^fixcart/$', self.fix_cart_lines, name='fix-cart-lines'),
             url(r'^view/$', self.cart_view, name='details'),
+            url(r'^summary/$', self.cart_summary, name='summary'),
         ]
 
     def fix_cart_lines(self, request, **kwargs):
@@ -124,3 +228,19 @@ class CartApp(ShopKitApp):
 
         context = self.get_context_data(request, **context)
         return render(request, self.cart_view_templates, context)
+
+    @method_decorator(require_GET)
+    def cart_summary(self, request, **kwargs):
+        """
+        Read-only JSON summary of cart (without forms), client may
+        revalidate it with If-None-Match header and get 304 response.
+        """
+        cart = self.get_cart_for_request(request)
+        etag = self.get_cart_summary_etag(cart)
+        response = etag and get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(self.get_cart_summary(cart))
+        if etag:
+            response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
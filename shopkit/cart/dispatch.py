@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from . import signals
+
+logger = logging.getLogger(__name__)
+
+SYNC, COMMIT, THREAD = 'sync', 'commit', 'thread'
+
+
+class CartChangesDispatcher(object):
+    """
+    Dispatcher of cart lines changes (cart_line_changed and
+    cart_lines_changed signals).
+
+    Mode is defined by SATCHLESS_CART_SIGNALS_DISPATCH setting:
+        "sync"   - signal is sent immediately on each change (default),
+        "commit" - changes are buffered until current transaction commit
+                   (or until end of request, see begin and flush methods)
+                   and sent inline,
+        "thread" - same as "commit", but signals are sent by thread pool
+                   worker (SATCHLESS_CART_SIGNALS_WORKERS threads), cart
+                   and its lines are reloaded by worker (changes of not
+                   saved carts are sent inline).
+
+    Buffered changes are coalesced: each line is sent once (with its last
+    state) and one signal is sent per cart - cart_line_changed for single
+    changed line, cart_lines_changed otherwise. Change made in atomic block
+    is moved to request buffer (or sent if there is none) by its own
+    transaction.on_commit callback, Django discards callbacks of rolled
+    back transaction or savepoint, so such changes are dropped. Changes
+    made outside of transaction and request buffer are sent at once.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    @property
+    def mode(self):
+        return getattr(settings, 'SATCHLESS_CART_SIGNALS_DISPATCH', SYNC)
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(getattr(
+                    settings, 'SATCHLESS_CART_SIGNALS_WORKERS', 2))
+        return self.pool
+
+    def begin(self):
+        """Start buffering of current thread's changes (e.g. per request)."""
+        if self.mode != SYNC:
+            self.local.request_buffer = OrderedDict()
+
+    def flush(self):
+        """Send all changes buffered since begin and stop buffering."""
+        buffer = self.local.__dict__.pop('request_buffer', None)
+        if buffer:
+            self.dispatch(buffer)
+
+    def send(self, cart, cart_lines):
+        """Send (or buffer) changes of `cart_lines` of `cart`."""
+        if not cart_lines:
+            return
+
+        using = cart._state.db or DEFAULT_DB_ALIAS
+        if self.mode != SYNC and connections[using].in_atomic_block:
+            transaction.on_commit(
+                partial(self.send_committed, cart, list(cart_lines)),
+                using=using)
+        else:
+            self.send_committed(cart, cart_lines)
+
+    def send_committed(self, cart, cart_lines):
+        """Buffer committed changes in request buffer or send them."""
+        buffer = getattr(self.local, 'request_buffer', None)
+        if buffer is None:
+            buffer = OrderedDict()
+            self.add(buffer, cart, cart_lines)
+            self.dispatch(buffer, inline=self.mode == SYNC)
+        else:
+            self.add(buffer, cart, cart_lines)
+
+    def add(self, buffer, cart, cart_lines):
+        key = (type(cart), cart.pk) if cart.pk else id(cart)
+        cart, lines = buffer.setdefault(key, (cart, OrderedDict(),))
+        for line in cart_lines:
+            lines[(line.variant_id, line.data_key,)] = line
+
+    def dispatch(self, buffer, inline=False):
+        events = [(cart, list(lines.values()))
+                  for cart, lines in buffer.values()]
+        if inline or self.mode != THREAD:
+            self.send_signals(events)
+            return
+
+        # worker gets primary keys only and reloads carts and lines
+        self.send_signals([(cart, lines) for cart, lines in events
+                           if not cart.pk])
+        events = [(type(cart), cart.pk, [(line.variant_id, line.data_key,)
+                                         for line in lines])
+                  for cart, lines in events if cart.pk]
+        if events:
+            self.get_pool().apply_async(self.send_signals_in_worker,
+                                        (events,))
+
+    def send_signals(self, events):
+        for cart, lines in events:
+            if len(lines) == 1:
+                signals.cart_line_changed.send(
+                    sender=type(cart), cart=cart, cart_line=lines[0])
+            else:
+                signals.cart_lines_changed.send(
+                    sender=type(cart), cart=cart, cart_lines=lines)
+
+    def load_events(self, events):
+        """
+        Return (cart, lines) events by (cart model, cart pk, line keys)
+        ones, carts and their lines are reloaded, removed lines are built
+        with zero quantity.
+        """
+        loaded = []
+        for model, pk, keys in events:
+            cart = model._default_manager.filter(pk=pk).first()
+            if cart is None:
+                continue
+            lines = {(line.variant_id, line.data_key,): line
+                     for line in cart.get_lines()}
+            loaded.append((cart, [
+                lines.get(key) or cart.lines.model(
+                    cart=cart, variant_id=key[0], data_key=key[1],
+                    quantity=0)
+                for key in keys]))
+        return loaded
+
+    def send_signals_in_worker(self, events):
+        try:
+            self.send_signals(self.load_events(events))
+        except Exception:
+            logger.exception('Cart changes signals sending failed.')
+        finally:
+            connections.close_all()  # worker thread's connections only
+
+
+dispatcher = CartChangesDispatcher()
@@ -2,7 +2,6 @@
 from django import forms
 from django.core.exceptions import ObjectDoesNotExist, NON_FIELD_ERRORS
 from django.utils.translation import ugettext_lazy as _
-from satchless.item import InsufficientStock
 
 
 class CartLineAddForm(forms.Form):
@@ -59,20 +58,21 @@ class CartLineAddForm(forms.Form):
             cart_line = self.cart.get_line(variant)
             cart_line_quantity = cart_line.quantity if cart_line else 0
             quantity += cart_line_quantity if not self.replace else 0
-            try:
-                variant.check_quantity(quantity)
-            except InsufficientStock as e:
-                remaining = e.item.get_stock()
-                qty_delta = remaining - cart_line_quantity
-                if qty_delta < 0:
-                    msg = self.error_messages['reduced-stock'] % abs(qty_delta)
-                elif remaining:
-                    msg = self.error_messages['insufficient-stock'] % remaining
-                else:
-                    msg = self.error_messages['empty-stock']
-                self.add_error('quantity', msg)
+            remaining = self.cart.check_variant_quantity(variant, quantity)
+            if remaining is not None:
+                self.add_error('quantity', self.get_stock_error_message(
+                    remaining, cart_line_quantity))
         return cleaned_data
 
+    def get_stock_error_message(self, remaining, cart_line_quantity=0):
+        """Return error message for `remaining` quantity in stock."""
+        qty_delta = remaining - cart_line_quantity
+        if qty_delta < 0:
+            return self.error_messages['reduced-stock'] % abs(qty_delta)
+        elif remaining:
+            return self.error_messages['insufficient-stock'] % remaining
+        return self.error_messages['empty-stock']
+
     def save(self):
         """Add or replace the product variant and quantity to the cart."""
         variant = self.get_variant(self.cleaned_data)
@@ -96,30 +96,29 @@ class CartLineReplaceForm(CartLineAddForm):
 
     variant = None
     cart_line = None
+    check_quantity = True  # check stock in clean_quantity
 
     def __init__(self, *args, **kwargs):
         self.variant = kwargs.pop('variant')
+        self.cart_line = kwargs.pop('cart_line', None)
+        self.check_quantity = kwargs.pop('check_quantity',
+                                         self.check_quantity)
 
         super(CartLineReplaceForm, self).__init__(
             *args, **dict(kwargs, product=self.variant.product))
 
-        self.cart_line = self.cart.get_line(self.variant)
+        if self.cart_line is None:
+            self.cart_line = self.cart.get_line(self.variant)
         # todo: check is cart_line exists in cart
 
     def clean_quantity(self):
         quantity = self.cleaned_data['quantity']
-        try:
-            self.variant.check_quantity(quantity)
-        except InsufficientStock as e:
-            remaining = e.item.get_stock()
-            qty_delta = remaining - self.cart_line.quantity
-            if qty_delta < 0:
-                msg = self.error_messages['reduced-stock'] % abs(qty_delta)
-            elif remaining:
-                msg = self.error_messages['insufficient-stock'] % remaining
-            else:
-                msg = self.error_messages['empty-stock']
-            raise forms.ValidationError(msg)
+        if not self.check_quantity:
+            return quantity
+        remaining = self.cart.check_variant_quantity(self.variant, quantity)
+        if remaining is not None:
+            raise forms.ValidationError(self.get_stock_error_message(
+                remaining, self.cart_line.quantity))
         return quantity
 
     def clean(self):
@@ -134,3 +133,87 @@ class CartLineReplaceForm(CartLineAddForm):
         """Update cart_line (replace quantity)."""
         return self.cart.add(
             self.variant, quantity=self.cleaned_data['quantity'], replace=True)
+
+
+class CartLineFormSet(object):
+    """
+    Set of CartLineReplaceForm forms for all cart lines.
+
+    Forms are built from one cart lines snapshot, quantities of all bound
+    forms are checked against stock at once (see
+    Cart.get_insufficient_lines) and all changes are saved by single
+    Cart.add_many call, so query count does not depend on lines count.
+    Only forms with received data are bound (and validated).
+    """
+
+    form_class = CartLineReplaceForm
+    prefix = 'cartline'
+
+    def __init__(self, data=None, cart=None, form_class=None, prefix=None):
+        self.data = data or {}
+        self.cart = cart
+        self.form_class = form_class or self.form_class
+        self.prefix = prefix or self.prefix
+        self.forms = [self.get_form(cart_line) for cart_line in cart]
+
+    def __iter__(self):
+        return iter(self.forms)
+
+    def __len__(self):
+        return len(self.forms)
+
+    def get_form(self, cart_line):
+        prefix = '%s-%i' % (self.prefix, cart_line.variant_id,)
+        received = '%s-quantity' % prefix in self.data
+        return self.form_class(
+            data=self.data if received else None, prefix=prefix,
+            cart=self.cart, variant=cart_line.variant, cart_line=cart_line,
+            check_quantity=False,
+            initial={'quantity': cart_line.get_quantity()})
+
+    @property
+    def bound_forms(self):
+        return [form for form in self.forms if form.is_bound]
+
+    def is_valid(self):
+        """
+        Validate all bound forms and check changed quantities against
+        stock at once. Returns True if at least one form is valid
+        (invalid forms are not saved).
+        """
+        if not hasattr(self, '_valid_forms'):
+            forms = [form for form in self.bound_forms if form.is_valid()]
+            changed = [
+                form for form in forms if form.cleaned_data['quantity'] and
+                form.cleaned_data['quantity'] != form.cart_line.quantity]
+            insufficient = self.cart.get_insufficient_lines([
+                self.cart.lines.model(variant=form.variant,
+                                      quantity=form.cleaned_data['quantity'],
+                                      data=form.cart_line.data,
+                                      data_key=form.cart_line.data_key)
+                for form in changed])
+            # lines of the same variant differ by data
+            changed = {(form.variant.pk, form.cart_line.data_key): form
+                       for form in changed}
+            for line, remaining in insufficient:
+                form = changed[(line.variant_id, line.data_key)]
+                form.add_error('quantity', form.get_stock_error_message(
+                    remaining, form.cart_line.quantity))
+            self._valid_forms = [form for form in forms if form.is_valid()]
+        return bool(self._valid_forms)
+
+    def save(self):
+        """Replace quantities of all valid forms lines at once."""
+        if not self.is_valid():
+            return []
+        forms = [form for form in self._valid_forms
+                 if form.cleaned_data['quantity'] != form.cart_line.quantity]
+        lines = self.cart.add_many([
+            (form.variant, form.cleaned_data['quantity'], form.cart_line.data)
+            for form in forms
+        ], replace=True, check_quantity=False)
+
+        # lines snapshot is reloaded by add_many, update forms lines in place
+        for form in forms:
+            form.cart_line.quantity = form.cleaned_data['quantity']
+        return lines
@@ -0,0 +1,59 @@
+import datetime
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = ('Delete expired (not updated for a long time) carts in small'
+            ' batches, each batch is committed separately.')
+
+    model = None  # cart model, Cart of shop's cart app by default
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--anonymous-days', type=int, default=7,
+            help='Expiration age of anonymous carts in days (default 7).')
+        parser.add_argument(
+            '--user-days', type=int, default=28,
+            help='Expiration age of user owned carts in days (default 28).')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Count of carts deleted in one transaction (default 1000).')
+        parser.add_argument(
+            '--sleep', type=float, default=0.1,
+            help='Pause between batches in seconds (default 0.1).')
+
+    def get_model(self):
+        return self.model or import_string(
+            settings.SATCHLESS_SHOP_APP).cart_app.Cart
+
+    def handle(self, *args, **options):
+        model = self.get_model()
+        now = timezone.now()
+        carts = model.objects.expired(
+            anonymous_before=now - datetime.timedelta(
+                days=options['anonymous_days']),
+            user_before=now - datetime.timedelta(days=options['user_days']))
+        # date_update index is used, deleted carts are not selected again
+        pks = carts.order_by().values_list('pk', flat=True)
+
+        total = 0
+        while True:
+            with transaction.atomic(using=carts.db):
+                batch = list(pks[:options['batch_size']])
+                if batch:
+                    # carts updated since selection are not deleted
+                    total += model.objects.delete_by_pk(batch, carts=carts)
+            if not batch:
+                break
+            if options['verbosity'] > 1:
+                self.stdout.write('Deleted %d carts.' % total)
+            if len(batch) < options['batch_size']:
+                break
+            time.sleep(options['sleep'])
+
+        self.stdout.write('Deleted %d expired carts.' % total)
@@ -1,3 +1,5 @@
+import operator
+from functools import reduce
 from django.db import models
 
 
@@ -14,3 +16,52 @@ class CartLineManager(models.Manager):
 
     def active(self):
         return self.get_queryset().active()
+
+
+class CartQuerySet(models.QuerySet):
+    def expired(self, anonymous_before=None, user_before=None):
+        """
+        Return carts not updated since given dates (anonymous and user
+        owned carts separately, None means never expired).
+        """
+        queries = []
+        if anonymous_before is not None:
+            queries.append(models.Q(user__isnull=True,
+                                    date_update__lt=anonymous_before))
+        if user_before is not None:
+            queries.append(models.Q(user__isnull=False,
+                                    date_update__lt=user_before))
+        if not queries:
+            return self.none()
+        return self.filter(reduce(operator.or_, queries))
+
+
+class CartManager(models.Manager):
+    queryset_class = CartQuerySet
+
+    def get_queryset(self):
+        return self.queryset_class(self.model, using=self._db)
+
+    def expired(self, anonymous_before=None, user_before=None):
+        return self.get_queryset().expired(anonymous_before=anonymous_before,
+                                           user_before=user_before)
+
+    def delete_by_pk(self, pks, carts=None):
+        """
+        Delete carts by primary keys with regular delete of pks batch, cart
+        lines (and other cascaded objects without signal receivers) are
+        deleted with single query each, without loading objects. Returns
+        count of deleted carts.
+
+        If `carts` queryset is given (e.g. expired carts), only carts still
+        matching it are deleted: they are locked (select for update) before
+        related objects are changed, so carts updated after selection of
+        pks are kept with all their lines. Should be called in transaction.
+        """
+        carts = self.get_queryset() if carts is None else carts
+        carts = carts.filter(pk__in=pks).order_by('pk')
+        pks = list(carts.select_for_update().values_list('pk', flat=True))
+        if not pks:
+            return 0
+        deleted = self.get_queryset().filter(pk__in=pks).delete()[1]
+        return deleted.get(self.model._meta.label, 0)
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
+from .dispatch import dispatcher
+
+
+class CartMiddleware(MiddlewareMixin):
+    """
+    Attach lazy memoized cart to request as request.cart.
+
+    Cart is loaded by cart_app.get_cart_for_request only when request.cart
+    is touched first time, same cart instance is returned to all ShopKitApp
+    views within request. New anonymous cart is neither saved nor its token
+    is stored until first write (its token is stored on response).
+
+    Shop application instance is defined by SATCHLESS_SHOP_APP setting,
+    e.g. "shop.core.app.shop_app". Should be placed after
+    AuthenticationMiddleware.
+
+    Cart changes signals are buffered within request and sent on response,
+    if deferred dispatch is enabled (see shopkit.cart.dispatch).
+    """
+
+    def get_cart_app(self):
+        return import_string(settings.SATCHLESS_SHOP_APP).cart_app
+
+    def process_request(self, request):
+        cart_app = self.get_cart_app()
+        dispatcher.begin()
+        request.cart_token_deferred = True
+        request.cart = SimpleLazyObject(
+            lambda: cart_app.get_cart_for_request(request))
+
+    def process_response(self, request, response):
+        if getattr(request, 'cart_token_deferred', False):
+            response = self.get_cart_app().save_cart_token(request, response)
+        dispatcher.flush()
+        return response
@@ -1,17 +1,33 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import operator
 from uuid import uuid4
 from django.conf import settings
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import MaxValueValidator, MinValueValidator
 from jsonfield import JSONField
-from satchless.item import ItemSet, ItemLine, InsufficientStock
-from ..utils import get_unique_uuid_string
-from . import signals
+from prices import Price
+from satchless.item import ItemSet, ItemLine
+from ..product.pricing import get_pricing_version
+from ..utils import get_unique_uuid_string, get_insufficient_lines
+from .storage import DATABASE_CART_STORAGE, get_cart_storage, get_data_key
+from .dispatch import dispatcher
 from . import managers
 
 
 class Cart(models.Model, ItemSet):
+    # related objects loaded with cart lines snapshot, extend if required
+    lines_select_related = ('variant', 'variant__product',)
+    lines_prefetch_related = ()
+
+    # merge_from strategies: f(current quantity, merged cart line quantity)
+    merge_strategies = {
+        'max': max,
+        'sum': operator.add,
+        'replace': lambda current, other: other,
+    }
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, blank=True, null=True,
         related_name='carts', on_delete=models.CASCADE)
@@ -20,8 +36,30 @@ class Cart(models.Model, ItemSet):
         _('token'), max_length=36, unique=True, editable=False,
         default=get_unique_uuid_string)
 
+    # denormalised counters, kept up to date by cart storage with every
+    # lines write (cached total is invalidated and computed on read, see
+    # get_cached_total)
+    line_count = models.PositiveIntegerField(
+        _('line count'), default=0, editable=False)
+    total_quantity = models.PositiveIntegerField(
+        _('total quantity'), default=0, editable=False)
+    total_net = models.DecimalField(
+        _('total (net)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+    total_gross = models.DecimalField(
+        _('total (gross)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+    total_currency = models.CharField(
+        _('total currency'), max_length=3, blank=True, editable=False)
+    total_version = models.CharField(
+        _('total pricing version'), max_length=64, blank=True,
+        editable=False)
+
     date_create = models.DateTimeField(editable=False, auto_now_add=True)
-    date_update = models.DateTimeField(editable=False, auto_now=True)
+    date_update = models.DateTimeField(editable=False, auto_now=True,
+                                       db_index=True)
+
+    objects = managers.CartManager()
 
     class Meta:
         abstract = True
@@ -30,11 +68,11 @@ class Cart(models.Model, ItemSet):
         return 'Cart(user=%s, token=%s)' % (self.user, self.token,)
 
     def __iter__(self):
-        for i in self.lines.active():
-            yield i
+        # iterate over copy, lines snapshot may be changed by add method
+        return iter(list(self.get_lines()))
 
     def __len__(self):
-        return self.lines.active().count()
+        return len(self.get_lines())
 
     def __nonzero__(self):
         return True  # need to set cart as True object if __len__ is zero
@@ -42,34 +80,155 @@ class Cart(models.Model, ItemSet):
     def get_currency(self, **kwargs):
         return settings.SATCHLESS_DEFAULT_CURRENCY
 
+    def get_pricing_version(self):
+        """
+        Return version of pricing context of cached total, total is
+        recomputed if version is changed. Catalog pricing version is
+        changed on price changes (see shopkit.product.pricing), increase
+        SATCHLESS_PRICING_VERSION setting value on other pricing changes
+        or extend if required.
+        """
+        return '%s:%s:%s' % (self.get_currency(),
+                             getattr(settings, 'SATCHLESS_PRICING_VERSION', 0),
+                             get_pricing_version(),)
+
+    def get_cached_total(self, **kwargs):
+        """
+        Return cart total from denormalised columns without loading and
+        pricing of lines. Total invalidated by cart change (or computed
+        with other pricing version) is computed on read and saved with
+        single update query, unless cart was changed since it was loaded.
+        Total of not saved cart and total with custom pricing context
+        (`kwargs`) are never cached.
+        """
+        if kwargs or not self.pk:
+            return (self.get_total(**kwargs) if self.get_lines() else
+                    Price(0, currency=self.get_currency()))
+        if not self.line_count:
+            return Price(0, currency=self.get_currency())
+
+        version = self.get_pricing_version()
+        if self.total_version != version or self.total_net is None:
+            total = self.get_total()
+            self.total_net, self.total_gross = total.net, total.gross
+            self.total_currency, self.total_version = total.currency, version
+            # lines written after cart was loaded may be missing in total
+            type(self)._default_manager.filter(
+                pk=self.pk, date_update=self.date_update).update(
+                    total_net=total.net, total_gross=total.gross,
+                    total_currency=total.currency, total_version=version)
+        return Price(net=self.total_net, gross=self.total_gross,
+                     currency=self.total_currency)
+
+    def get_storage(self):
+        """
+        Return cart lines storage, saved carts are always stored in db,
+        new ones in storage defined by SATCHLESS_CART_STORAGE setting.
+        """
+        return get_cart_storage(DATABASE_CART_STORAGE if self.pk else None)
+
+    def get_lines_queryset(self):
+        lines = self.lines.active()
+        lines = lines.select_related(*self.lines_select_related)
+        return lines.prefetch_related(*self.lines_prefetch_related)
+
+    def get_lines(self):
+        """
+        Return a snapshot (list) of active cart lines.
+        Lines are loaded once per cart instance from cart storage with all
+        related objects, required for pricing, and patched in place by add
+        method, so cart iteration, counting, line lookup and totals work
+        from memory.
+        """
+        if not hasattr(self, '_lines_cache'):
+            lines = self.get_storage().load_lines(self)
+            for line in lines:
+                line.cart = self
+            self._lines_cache = lines
+            if not self.pk:
+                # counters of not saved cart are not stored, set them on load
+                self.line_count = len(lines)
+                self.total_quantity = sum(line.quantity for line in lines)
+        return self._lines_cache
+
+    def clear_lines_cache(self):
+        """Drop lines snapshot, it will be reloaded on next access."""
+        self.__dict__.pop('_lines_cache', None)
+
     def get_line(self, variant, data=None):
         """Return a line matching the given variant and data."""
-        if data is None:
-            data = {}
-        lines = self.lines.active().filter(variant=variant)
-        lines = [line for line in lines if line.data == data]
+        data_key = get_data_key(data)
+        variant_id = getattr(variant, 'pk', variant)
+        lines = [line for line in self.get_lines()
+                 if line.variant_id == variant_id and
+                 line.data_key == data_key]
         return lines[0] if lines else None
 
     def is_empty(self):
-        return not self.lines.active().exists()
-
-    def check_lines_quantities(self):
-        try:
-            for line in self.lines.active():
-                if not line.quantity:
-                    return False
-                line.variant.check_quantity(line.quantity)
-        except InsufficientStock:
-            return False
-        return True
-
-    def fix_lines_quantities(self):
-        for line in self.lines.active():
-            try:
-                line.variant.check_quantity(line.quantity)
-            except InsufficientStock:
-                self.add(line.variant, quantity=line.variant.get_stock(),
-                         data=line.data, replace=True, check_quantity=True)
+        return not self.get_lines()
+
+    def get_fingerprint(self):
+        """
+        Return hash of cart lines state (variants, data, quantities and
+        current unit prices) and pricing version, changed on any cart or
+        price change affecting orders. Lines are priced in memory (see
+        get_lines_prices).
+        """
+        state = sorted('%s:%s:%s:%s:%s' % (line.variant_id, line.data_key,
+                                           line.quantity, price.net,
+                                           price.gross,)
+                       for line, price in self.get_lines_prices())
+        state = '%s;%s' % (';'.join(state), self.get_pricing_version(),)
+        return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+    def get_lines_prices(self, **kwargs):
+        """
+        Return list of (line, price per item) pairs for all cart lines,
+        priced in one pass over lines snapshot with all related objects,
+        required for pricing, loaded at once (see lines_select_related).
+        Keyword arguments are passed to lines as pricing context.
+        """
+        return [(line, line.get_price_per_item(cart=self, **kwargs))
+                for line in self.get_lines()]
+
+    def get_insufficient_lines(self, lines=None, **kwargs):
+        """
+        Return list of (line, available quantity) pairs for cart lines (or
+        for given `lines` of this cart) with insufficient stock, all lines
+        are checked at once (see shopkit.utils.get_insufficient_lines).
+        """
+        return get_insufficient_lines(self if lines is None else lines,
+                                      **kwargs)
+
+    def check_lines_quantities(self, **kwargs):
+        return not self.get_insufficient_lines(**kwargs)
+
+    def check_variant_quantity(self, variant, quantity):
+        """
+        Check stock of `quantity` items of variant for this cart, return
+        available quantity if it is insufficient or None otherwise.
+        Checked by get_insufficient_lines, so stock hold by cart's own
+        orders is available (see CartStockReservationMixin).
+        """
+        if not quantity:
+            return None
+        insufficient = self.get_insufficient_lines(
+            [self.lines.model(variant=variant, quantity=quantity)])
+        return insufficient[0][1] if insufficient else None
+
+    def fix_lines_quantities(self, **kwargs):
+        """
+        Reduce quantities of lines with insufficient stock to available
+        stock level (or delete lines) with single update and delete query.
+        """
+        insufficient = self.get_insufficient_lines(**kwargs)
+        if not insufficient:
+            return
+
+        self.get_storage().set_quantities(self, insufficient)
+
+        # inform about changed lines
+        dispatcher.send(self, [line for line, quantity in insufficient])
 
     def add(self, variant, quantity=1, data=None, replace=False,
             check_quantity=True):
@@ -79,34 +238,73 @@ class Cart(models.Model, ItemSet):
         different customization options.
         If `replace` is truthy then any previous quantity is discarded instead
         of added to.
-        """
-        # todo: do nothing if quantity is zero and cart_line does not exists
-
-        if not self.pk:
-            self.save()  # just try to prevent saving on get from request
 
-        cart_line, _ = self.lines.get_or_create(
-            variant=variant, defaults={'quantity': 0, 'data': data or {},})
+        Line is written by cart storage (see DatabaseCartStorage.add for
+        concurrency details) and lines snapshot is updated in place.
+        """
+        data = data or {}
+        if replace and quantity < 0:
+            raise ValueError('%r is not a valid quantity' % quantity)
 
-        new_quantity = quantity if replace else cart_line.quantity + quantity
-        if new_quantity < 0:
-            raise ValueError('%r is not a valid quantity (results in %r)' % (
-                quantity, new_quantity))
+        cart_line = self.get_storage().add(
+            self, variant, quantity, data, replace=replace,
+            check_quantity=check_quantity)
 
-        if check_quantity:
-            variant.check_quantity(new_quantity)
+        dispatcher.send(self, [cart_line])
 
-        cart_line.quantity = new_quantity
+        return cart_line
 
-        if not cart_line.quantity:
-            cart_line.delete()
-        else:
-            cart_line.save(update_fields=['quantity'])
+    def add_many(self, items, replace=False, check_quantity=True):
+        """
+        Add many product variants to cart at once.
+        The `items` is an iterable of (variant, quantity, data) tuples,
+        quantities of repeated variant and data pairs are summed up (or the
+        last one is used if `replace` is truthy).
+
+        Stock is checked for all lines with single query, lines are written
+        by cart storage at once and changes are dispatched once (see
+        shopkit.cart.dispatch).
+        Returns list of changed lines.
+        """
+        lines = self.get_storage().add_many(
+            self, items, replace=replace, check_quantity=check_quantity)
+        if lines:
+            dispatcher.send(self, lines)
 
-        signals.cart_line_changed.send(sender=type(self),
-                                       cart=self, cart_line=cart_line)
+        return lines
 
-        return cart_line
+    def merge_from(self, cart, strategy='max'):
+        """
+        Merge all lines from another cart (e.g. anonymous cart on login).
+        Resulting quantities are computed in memory from both carts lines
+        snapshots by `strategy` ("max", "sum" or "replace", see
+        merge_strategies), written by add_many in one bulk write (stock is
+        not checked) and lines of merged cart are cleared at once.
+        Returns list of changed lines.
+        """
+        if cart is self or (cart.pk and cart.pk == self.pk):
+            return []
+
+        merge = self.merge_strategies[strategy]
+        items = []
+        for line in cart:
+            current = self.get_line(line.variant_id, data=line.data)
+            current = current.quantity if current is not None else 0
+            items.append(
+                (line.variant, merge(current, line.quantity), line.data,))
+
+        lines = self.add_many(items, replace=True, check_quantity=False)
+        if items:
+            cart.get_storage().clear(cart)
+        return lines
+
+    def materialize(self):
+        """
+        Save cart and its lines to db if cart lines are kept in other
+        storage (e.g. in cache), called before order creation.
+        """
+        if not self.pk:
+            self.get_storage().materialize(self)
 
 
 class CartLine(models.Model, ItemLine):
@@ -119,6 +317,8 @@ class CartLine(models.Model, ItemLine):
         _('quantity'), default=1,
         validators=[MinValueValidator(0), MaxValueValidator(999),])
     data = JSONField(blank=True, default={})
+    # canonical hash of data, kept up to date on save (see get_data_key)
+    data_key = models.CharField(max_length=40, editable=False)
 
     date_create = models.DateTimeField(editable=False, auto_now_add=True)
     date_update = models.DateTimeField(editable=False, auto_now=True)
@@ -126,7 +326,7 @@ class CartLine(models.Model, ItemLine):
     objects = managers.CartLineManager()
 
     class Meta:
-        unique_together = ('cart', 'variant', 'data',)
+        unique_together = ('cart', 'variant', 'data_key',)
         abstract = True
 
     def __unicode__(self):
@@ -147,6 +347,13 @@ class CartLine(models.Model, ItemLine):
     def __ne__(self, other):
         return not self == other
 
+    def save(self, *args, **kwargs):
+        self.data_key = get_data_key(self.data)
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and 'data' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'data_key'}
+        return super(CartLine, self).save(*args, **kwargs)
+
     def __getstate__(self):
         return self.variant, self.quantity, self.data
 
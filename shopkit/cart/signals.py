@@ -6,4 +6,15 @@ cart_line_changed.__doc__ = """
 Sent whenever cart's line has been changed, added or removed.
 Technically, removed line is added with zero quantity, such cart_line will be
 already removed from storage and will have zero quantity.
+With deferred dispatch (see shopkit.cart.dispatch) it is sent once on commit
+if only one line of cart has been changed.
+"""
+
+
+cart_lines_changed = dispatch.Signal(providing_args=['cart', 'cart_lines',])
+cart_lines_changed.__doc__ = """
+Sent once after many cart's lines have been changed, added or removed at once
+(by bulk operations like Cart.add_many) instead of cart_line_changed signal
+for each line. Removed lines have zero quantity. With deferred dispatch it is
+sent once per cart on commit for all coalesced changes of cart's lines.
 """
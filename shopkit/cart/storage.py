@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from satchless.item import InsufficientStock
+from ..utils import update_by_pk
+
+
+DATABASE_CART_STORAGE = 'shopkit.cart.storage.DatabaseCartStorage'
+_storages = {}
+
+
+def get_data_key(data):
+    """
+    Return canonical (keys order independent) hash of cart line data,
+    used for indexed lookup and uniqueness of cart lines.
+    """
+    data = json.dumps(data or {}, sort_keys=True, separators=(',', ':'),
+                      cls=DjangoJSONEncoder)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_cart_storage(path=None):
+    """
+    Return cart storage instance (memoized) by path to its class,
+    SATCHLESS_CART_STORAGE setting value is used by default.
+    """
+    path = path or getattr(settings, 'SATCHLESS_CART_STORAGE',
+                           DATABASE_CART_STORAGE)
+    if path not in _storages:
+        _storages[path] = import_string(path)()
+    return _storages[path]
+
+
+class CartStorage(object):
+    """
+    Base cart storage class.
+
+    Class responsible for loading and writing cart lines. Cart delegates to
+    its storage lines snapshot loading and all write operations, storage
+    should keep cart's lines snapshot (cart.get_lines()) up to date.
+    """
+    def exists(self, cart):
+        """Is cart stored (it has been written at least once)."""
+        raise NotImplementedError()
+
+    def load_lines(self, cart):
+        """Return list of cart lines with all related objects."""
+        raise NotImplementedError()
+
+    def load_token(self, cart):
+        """Return stored token of not saved cart, if storage keeps it."""
+        return None
+
+    def add(self, cart, variant, quantity, data, replace=False,
+            check_quantity=True):
+        """Add (or replace) quantity of line, return changed line."""
+        raise NotImplementedError()
+
+    def add_many(self, cart, items, replace=False, check_quantity=True):
+        """Add (or replace) many lines at once, return changed lines."""
+        raise NotImplementedError()
+
+    def set_quantities(self, cart, quantities):
+        """Set quantities of lines ((line, quantity) pairs), zero deletes."""
+        raise NotImplementedError()
+
+    def clear(self, cart):
+        """Delete all cart lines."""
+        raise NotImplementedError()
+
+    def materialize(self, cart):
+        """Save cart and all its lines to db."""
+        raise NotImplementedError()
+
+    def get_changes(self, items, replace=False):
+        """
+        Group items ((variant, quantity, data) tuples) by variant and data,
+        quantities of repeated pairs are summed up (or the last one is used
+        if `replace` is truthy).
+        """
+        changes = OrderedDict()
+        for variant, quantity, data in items:
+            key = (variant.pk, get_data_key(data),)
+            if replace or key not in changes:
+                changes[key] = [variant, quantity, data or {}]
+            else:
+                changes[key][1] += quantity
+        return changes
+
+    def get_new_quantity(self, line, quantity, replace=False):
+        new_quantity = quantity if replace else line.quantity + quantity
+        if new_quantity < 0:
+            raise ValueError('%r is not a valid quantity (results in %r)' % (
+                quantity, new_quantity))
+        return new_quantity
+
+    def check_lines(self, cart, lines):
+        """
+        Check stock for all non-empty lines at once (by cart, so cart's own
+        holds are not counted, see Cart.get_insufficient_lines).
+        """
+        insufficient = cart.get_insufficient_lines(
+            [line for line in lines if line.quantity])
+        if insufficient:
+            raise InsufficientStock(insufficient[0][0].variant)
+
+    def patch_lines(self, cart, changed):
+        """Update cart's lines snapshot in place by changed lines."""
+        lines = cart.get_lines()
+        for line in changed:
+            if not line.quantity:
+                lines[:] = [i for i in lines if i is not line]
+            elif not any(i is line for i in lines):
+                lines.append(line)
+
+
+class DatabaseCartStorage(CartStorage):
+    """
+    Store cart lines in db (CartLine model), cart is saved on first write.
+    Used for all carts already saved in db.
+    """
+    def exists(self, cart):
+        return bool(cart.pk)
+
+    def load_lines(self, cart):
+        return list(cart.get_lines_queryset()) if cart.pk else []
+
+    def can_upsert_lines(self, cart):
+        """Is single statement upsert of cart lines supported by db."""
+        connection = connections[cart._state.db or DEFAULT_DB_ALIAS]
+        return (connection.vendor == 'postgresql' and
+                connection.pg_version >= 90500)
+
+    def upsert_line(self, cart, variant, quantity, data):
+        """
+        Add quantity to line with single INSERT ... ON CONFLICT DO UPDATE
+        statement, returns resulting line pk and quantity.
+        Quantity should not be negative.
+        """
+        connection = connections[cart._state.db or DEFAULT_DB_ALIAS]
+        qn = connection.ops.quote_name
+        opts = cart.lines.model._meta
+        now = timezone.now()
+        values = [
+            ('cart', cart.pk), ('variant', getattr(variant, 'pk', variant)),
+            ('quantity', quantity), ('data', data),
+            ('data_key', get_data_key(data)),
+            ('date_create', now), ('date_update', now),
+        ]
+        columns, params = {}, []
+        for name, value in values:
+            field = opts.get_field(name)
+            columns[name] = qn(field.column)
+            params.append(field.get_db_prep_save(value, connection))
+
+        table = qn(opts.db_table)
+        sql = (
+            'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s)'
+            ' ON CONFLICT (%(unique)s) DO UPDATE SET'
+            ' %(quantity)s = %(quantity_value)s,'
+            ' %(date_update)s = EXCLUDED.%(date_update)s'
+            ' RETURNING %(pk)s, %(quantity)s'
+        ) % {
+            'table': table,
+            'columns': ', '.join(columns[name] for name, value in values),
+            'values': ', '.join(['%s'] * len(params)),
+            'unique': ', '.join(columns[name]
+                                for name in ('cart', 'variant', 'data_key',)),
+            'quantity': columns['quantity'],
+            'quantity_value': '%s.%s + EXCLUDED.%s' % (
+                table, columns['quantity'], columns['quantity']),
+            'date_update': columns['date_update'],
+            'pk': qn(opts.pk.column),
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+
+    def lock_cart(self, cart):
+        carts = type(cart)._default_manager.select_for_update()
+        list(carts.filter(pk=cart.pk).values_list('pk'))
+
+    def change_counters(self, cart, line_count, total_quantity):
+        """
+        Change cart counters by given deltas with single update query (by
+        F() expressions, so concurrent changes are never lost) and
+        invalidate cached total (it is computed on read, see
+        Cart.get_cached_total). Should be called in transaction of lines
+        write.
+        """
+        now = timezone.now()
+        type(cart)._default_manager.filter(pk=cart.pk).update(
+            line_count=F('line_count') + line_count,
+            total_quantity=F('total_quantity') + total_quantity,
+            total_version='', date_update=now)
+        cart.line_count += line_count
+        cart.total_quantity += total_quantity
+        cart.total_version, cart.date_update = '', now
+
+    def recount_counters(self, cart):
+        """
+        Recompute cart counters by aggregate subqueries of its lines with
+        single update query and invalidate cached total. Should be called
+        in transaction of lines write with cart row locked before lines
+        were written (see lock_cart), so lines of concurrent writes are
+        counted or added by their deltas later (see change_counters).
+        """
+        lines = cart.lines.model._default_manager.filter(
+            cart=OuterRef('pk')).order_by().values('cart')
+        counters = {
+            'line_count': lines.annotate(value=Count('pk')),
+            'total_quantity': lines.annotate(value=Sum('quantity')),
+        }
+        type(cart)._default_manager.filter(pk=cart.pk).update(
+            total_version='', date_update=timezone.now(), **{
+                name: Coalesce(Subquery(queryset.values('value'),
+                                        output_field=IntegerField()), 0)
+                for name, queryset in counters.items()})
+        cart.refresh_from_db(fields=('line_count', 'total_quantity',
+                                     'total_version', 'date_update',))
+
+    def update_line_locked(self, cart, variant, quantity, data,
+                           replace=False):
+        """
+        Add (or replace) quantity of line with cart row locked, used if
+        upsert is not supported, returns resulting line pk, quantity and
+        previous quantity. Line with zero resulting quantity is not saved.
+        """
+        self.lock_cart(cart)
+        cart_line = cart.lines.filter(
+            variant=variant, data_key=get_data_key(data)).first()
+        cart_line = cart_line or cart.lines.model(
+            cart=cart, variant=variant, quantity=0, data=data)
+
+        old_quantity = cart_line.quantity
+        new_quantity = self.get_new_quantity(cart_line, quantity, replace)
+        if new_quantity and cart_line.pk:
+            cart_line.quantity = new_quantity
+            cart_line.save(update_fields=['quantity', 'date_update'])
+        elif new_quantity:
+            cart_line.quantity = new_quantity
+            cart_line.save()
+
+        return cart_line.pk, new_quantity, old_quantity
+
+    def add(self, cart, variant, quantity, data, replace=False,
+            check_quantity=True):
+        """
+        Line quantity is added with single upsert statement where db
+        supports it (or written with cart row locked otherwise) in one
+        transaction with stock check and cart counters change, so
+        concurrent adds to the same cart do not fail or lose quantities
+        and counters.
+        """
+        if not cart.pk:
+            cart.save()  # just try to prevent saving on get from request
+
+        with transaction.atomic(using=cart._state.db):
+            if not replace and quantity >= 0 and self.can_upsert_lines(cart):
+                line_pk, new_quantity = self.upsert_line(
+                    cart, variant, quantity, data)
+                # existing lines have positive quantities
+                old_quantity = new_quantity - quantity
+            else:
+                line_pk, new_quantity, old_quantity = (
+                    self.update_line_locked(cart, variant, quantity, data,
+                                            replace=replace))
+
+            if check_quantity:
+                self.check_lines(cart, [cart.lines.model(
+                    variant=variant, quantity=new_quantity)])
+
+            if line_pk and not new_quantity:
+                cart.lines.filter(pk=line_pk).delete()
+
+            self.change_counters(
+                cart, int(bool(new_quantity)) - int(bool(old_quantity)),
+                new_quantity - old_quantity)
+
+        # update lines snapshot in place instead of reloading it
+        cart_line = cart.get_line(variant, data=data)
+        if cart_line is None:
+            cart_line = cart.lines.model(cart=cart, variant=variant,
+                                         data=data,
+                                         data_key=get_data_key(data))
+        cart_line.pk = line_pk if new_quantity else None
+        cart_line.quantity = new_quantity
+        self.patch_lines(cart, [cart_line])
+
+        return cart_line
+
+    def add_many(self, cart, items, replace=False, check_quantity=True):
+        """
+        Stock is checked for all lines with single query, lines are written
+        with one insert, update and delete query.
+        """
+        changes = self.get_changes(items, replace=replace)
+        if not changes:
+            return []
+
+        if not cart.pk:
+            cart.save()
+
+        with transaction.atomic(using=cart._state.db):
+            self.lock_cart(cart)
+            existing = cart.lines.filter(
+                variant__in=[variant_id for variant_id, _ in changes])
+            existing = {(line.variant_id, line.data_key): line
+                        for line in existing}
+
+            lines = []
+            for key, (variant, quantity, data) in changes.items():
+                line = existing.get(key) or cart.lines.model(
+                    cart=cart, quantity=0, data=data, data_key=key[1])
+                line.quantity = self.get_new_quantity(line, quantity, replace)
+                line.variant = variant
+                lines.append(line)
+
+            if check_quantity:
+                self.check_lines(cart, lines)
+
+            cart.lines.model._default_manager.bulk_create(
+                [line for line in lines if not line.pk and line.quantity])
+            update_by_pk(cart.lines.all(), 'quantity', {
+                line.pk: line.quantity for line in lines
+                if line.pk and line.quantity
+            }, date_update=timezone.now())
+            cart.lines.filter(pk__in=[
+                line.pk for line in lines if line.pk and not line.quantity
+            ]).delete()
+            self.recount_counters(cart)
+
+        # created lines may have no pk (depends on db), reload snapshot
+        cart.clear_lines_cache()
+        return lines
+
+    def set_quantities(self, cart, quantities):
+        """Lines are updated with single update and delete query."""
+        with transaction.atomic(using=cart._state.db):
+            self.lock_cart(cart)
+            update_by_pk(cart.lines.all(), 'quantity', {
+                line.pk: quantity for line, quantity in quantities
+                if quantity})
+            cart.lines.filter(pk__in=[
+                line.pk for line, quantity in quantities if not quantity
+            ]).delete()
+            self.recount_counters(cart)
+
+        for line, quantity in quantities:
+            line.quantity = quantity
+            line.pk = line.pk if quantity else None
+        self.patch_lines(cart, [line for line, quantity in quantities])
+
+    def clear(self, cart):
+        if cart.pk:
+            with transaction.atomic(using=cart._state.db):
+                self.lock_cart(cart)
+                cart.lines.all().delete()
+                self.recount_counters(cart)
+        cart.clear_lines_cache()
+
+    def materialize(self, cart):
+        if not cart.pk:
+            cart.save()
+
+
+class CacheCartStorage(CartStorage):
+    """
+    Store lines of new carts in django cache (until cart is materialized).
+
+    Lines are stored as list of (variant id, quantity, data) items with
+    cart token under cart token (or user id) key, so not saved user cart
+    keeps its token between requests (see load_token). Cart and its lines
+    are saved to db only by materialize (e.g. in
+    CheckoutApp.prepare_order), after it cart uses DatabaseCartStorage.
+    Cache alias and timeout are defined by SATCHLESS_CART_CACHE (default
+    is "default") and SATCHLESS_CART_CACHE_TIMEOUT (in seconds, one week by
+    default) settings.
+
+    Writes to the same cart are serialized by short lived lock (added with
+    atomic cache.add, see lock) and quantities are changed on stored items
+    read under lock, so concurrent writes are not lost.
+    """
+    key_prefix = 'shopkit-cart'
+    # lock expiration (in case of crashed writer) and polling interval
+    lock_timeout = 5
+    lock_interval = 0.01
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, 'SATCHLESS_CART_CACHE',
+                                    'default')]
+        self.timeout = getattr(settings, 'SATCHLESS_CART_CACHE_TIMEOUT',
+                               60 * 60 * 24 * 7)
+
+    def get_key(self, cart):
+        owner = 'user-%s' % cart.user_id if cart.user_id else cart.token
+        return '%s:%s' % (self.key_prefix, owner,)
+
+    @contextmanager
+    def lock(self, cart):
+        """Hold write lock of cart, wait for other writer if required."""
+        key, owner = '%s:lock' % self.get_key(cart), uuid4().hex
+        while not self.cache.add(key, owner, self.lock_timeout):
+            time.sleep(self.lock_interval)
+        try:
+            yield
+        finally:
+            if self.cache.get(key) == owner:
+                self.cache.delete(key)
+
+    def get_stored(self, cart):
+        return self.cache.get(self.get_key(cart)) or {}
+
+    def get_items(self, cart):
+        """Return stored items by (variant id, data key)."""
+        return OrderedDict(
+            ((variant_id, get_data_key(data)), (variant_id, quantity, data))
+            for variant_id, quantity, data in self.get_stored(cart).get(
+                'items', []))
+
+    def save_items(self, cart, items, lines):
+        """Store items changed by lines (zero quantity deletes item)."""
+        for line in lines:
+            key = (line.variant_id, line.data_key)
+            if line.quantity:
+                items[key] = (line.variant_id, line.quantity, line.data)
+            else:
+                items.pop(key, None)
+        self.cache.set(self.get_key(cart), {
+            'token': cart.token, 'items': list(items.values())},
+            self.timeout)
+        # counters of not saved cart are kept in memory only
+        cart.line_count = len(items)
+        cart.total_quantity = sum(
+            quantity for variant_id, quantity, data in items.values())
+
+    def exists(self, cart):
+        return self.cache.get(self.get_key(cart)) is not None
+
+    def load_token(self, cart):
+        return self.get_stored(cart).get('token')
+
+    def load_lines(self, cart):
+        items = self.get_items(cart).values()
+        if not items:
+            return []
+
+        # load variants with related objects, required for pricing
+        model = cart.lines.model
+        related = [name.split('__', 1)[1] for name in cart.lines_select_related
+                   if name.startswith('variant__')]
+        prefetch = [name.split('__', 1)[1]
+                    for name in cart.lines_prefetch_related
+                    if name.startswith('variant__')]
+        variants = model._meta.get_field('variant').related_model
+        variants = variants._default_manager.select_related(*related)
+        variants = variants.prefetch_related(*prefetch).in_bulk(
+            [variant_id for variant_id, quantity, data in items])
+
+        return [model(cart=cart, variant=variants[variant_id],
+                      quantity=quantity, data=data,
+                      data_key=get_data_key(data))
+                for variant_id, quantity, data in items
+                if variant_id in variants]
+
+    def add(self, cart, variant, quantity, data, replace=False,
+            check_quantity=True):
+        cart_line = cart.get_line(variant, data=data) or cart.lines.model(
+            cart=cart, variant=variant, quantity=0, data=data,
+            data_key=get_data_key(data))
+
+        with self.lock(cart):
+            items = self.get_items(cart)
+            stored = items.get((variant.pk, cart_line.data_key))
+            cart_line.quantity = stored[1] if stored else 0
+            new_quantity = self.get_new_quantity(cart_line, quantity, replace)
+            if check_quantity:
+                self.check_lines(cart, [cart.lines.model(
+                    variant=variant, quantity=new_quantity)])
+
+            cart_line.quantity = new_quantity
+            self.save_items(cart, items, [cart_line])
+        self.patch_lines(cart, [cart_line])
+        return cart_line
+
+    def add_many(self, cart, items, replace=False, check_quantity=True):
+        changes = self.get_changes(items, replace=replace)
+        if not changes:
+            return []
+
+        with self.lock(cart):
+            stored = self.get_items(cart)
+            lines = []
+            for key, (variant, quantity, data) in changes.items():
+                line = cart.get_line(variant, data=data) or cart.lines.model(
+                    cart=cart, variant=variant, quantity=0, data=data,
+                    data_key=key[1])
+                line.quantity = stored[key][1] if key in stored else 0
+                lines.append((line, self.get_new_quantity(line, quantity,
+                                                          replace),))
+
+            if check_quantity:
+                self.check_lines(cart, [
+                    cart.lines.model(variant=line.variant, quantity=quantity)
+                    for line, quantity in lines])
+
+            for line, quantity in lines:
+                line.quantity = quantity
+            lines = [line for line, quantity in lines]
+            self.save_items(cart, stored, lines)
+        self.patch_lines(cart, lines)
+        return lines
+
+    def set_quantities(self, cart, quantities):
+        with self.lock(cart):
+            for line, quantity in quantities:
+                line.quantity = quantity
+            lines = [line for line, quantity in quantities]
+            self.save_items(cart, self.get_items(cart), lines)
+        self.patch_lines(cart, lines)
+
+    def clear(self, cart):
+        with self.lock(cart):
+            self.cache.delete(self.get_key(cart))
+        cart.clear_lines_cache()
+
+    def materialize(self, cart):
+        """Save cart and its lines (with bulk insert) and clear cache."""
+        if cart.pk:
+            return
+
+        items = [(line.variant, line.quantity, line.data,)
+                 for line in cart.get_lines()]
+        cart.save()
+        get_cart_storage(DATABASE_CART_STORAGE).add_many(
+            cart, items, replace=True, check_quantity=False)
+        self.clear(cart)
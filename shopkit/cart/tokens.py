@@ -0,0 +1,50 @@
+from django.core.exceptions import ImproperlyConfigured
+
+
+class CartTokenStorage(object):
+    """
+    Base cart token storage class.
+
+    Class responsible for storing anonymous cart's token between requests.
+    """
+    def __init__(self, name='shop-cart'):
+        self.name = name
+
+    def get_token(self, request):
+        raise NotImplementedError()
+
+    def set_token(self, request, response, token):
+        """
+        Store token, response is None if token should be stored before
+        response is created (CartMiddleware is not used).
+        """
+        raise NotImplementedError()
+
+
+class SessionCartTokenStorage(CartTokenStorage):
+    """Store cart token in session (under `name` key)."""
+    def get_token(self, request):
+        return request.session.get(self.name, None)
+
+    def set_token(self, request, response, token):
+        request.session[self.name] = token
+
+
+class SignedCookieCartTokenStorage(CartTokenStorage):
+    """
+    Store cart token in signed cookie (named `name`), session store is not
+    touched at all. Requires CartMiddleware to set cookie on response.
+    """
+    salt = 'shopkit.cart.token'
+    max_age = 60 * 60 * 24 * 28  # in seconds
+
+    def get_token(self, request):
+        return request.get_signed_cookie(self.name, default=None,
+                                         salt=self.salt, max_age=self.max_age)
+
+    def set_token(self, request, response, token):
+        if response is None:
+            raise ImproperlyConfigured(
+                '%s requires CartMiddleware.' % type(self).__name__)
+        response.set_signed_cookie(self.name, token, salt=self.salt,
+                                   max_age=self.max_age, httponly=True)
@@ -3,11 +3,14 @@ from django.core.exceptions import ImproperlyConfigured
 from django.db.models import Q
 from django.shortcuts import redirect, render
 from django.utils.decorators import method_decorator
+from django.utils import timezone
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.conf.urls import url
 
 from ..core.app import ShopKitApp
+from .context import CheckoutContext
+from ..utils import update_by_pk
 from ..order import handler
 from ..order.signals import order_pre_confirm
 from ..payment import PaymentFailure, ConfirmationFormNeeded, RedirectRequired
@@ -20,6 +23,10 @@ class CheckoutApp(ShopKitApp):
     namespace = 'checkout'
 
     Order = None
+    CheckoutContext = CheckoutContext
+
+    # related objects loaded with order by checkout context, extend if required
+    order_prefetch_related = ('groups__lines__variant__product',)
 
     confirmation_templates = [
         'shopkit/checkout/confirmation.html',
@@ -41,37 +48,120 @@ class CheckoutApp(ShopKitApp):
         assert self.Order, (
             'You need to subclass CheckoutApp and provide Order model class.')
 
-    def get_order(self, request, token):
+    def get_order_queryset(self, request):
         user = request.user if request.user.is_authenticated else None
-        return self.Order.objects.filter(token=token, user=user).first()
+        return self.Order.objects.filter(user=user)
+
+    def get_order(self, request, token):
+        return self.get_order_queryset(request).filter(token=token).first()
+
+    def get_checkout_context(self, request, order_token):
+        """Return checkout context (order graph loaded once) of request."""
+        return self.CheckoutContext(self, request, order_token)
 
     def get_order_from_cart(self, request, cart):
         """
-        Create or get any cart's previous order in CHECKOUT status,
-        clean it (remove all delivery groups) and partition by cart items.
+        Create or get any cart's previous order in CHECKOUT status and
+        partition it by cart items. Previous order is re-partitioned (and its
+        totals are updated) only if cart was changed since last partitioning
+        (by cart fingerprint).
         """
         order = self.Order.objects.filter(
             status=self.Order.SC.CHECKOUT, cart=cart).first()
         if not order:
             order = self.Order.objects.create(cart=cart, user=cart.user)
-        else:
-            order.groups.all().delete()
 
-        self.partition_cart(cart, order)
+        fingerprint = cart.get_fingerprint()
+        if order.cart_fingerprint != fingerprint:
+            self.partition_cart(cart, order)
+            order.update_totals()
+            order.cart_fingerprint = fingerprint
+            self.Order.objects.filter(pk=order.pk).update(
+                cart_fingerprint=fingerprint)
         return order
 
     def partition_cart(self, cart, order, **pricing_context):
+        """
+        Create (or update) delivery groups and order lines of order by cart
+        partitions. Existing groups (with entered shipping and delivery
+        data) are reused by partition's shipping flag and existing lines by
+        variant, so only changed lines are updated, new groups and lines
+        are inserted with bulk queries and stale ones are deleted.
+        All lines are priced in one pass over cart lines snapshot.
+        """
         partitions, remaining = self.delivery_partitioner.partition(cart, None)
 
         if remaining:
             raise ImproperlyConfigured('Unhandled items remaining in cart.')
-        for partition in filter(None, partitions):
-            delivery_group = order.create_delivery_group(partition)
+
+        partitions = [partition for partition in partitions if partition]
+        prices = {id(cart_line): price for cart_line, price
+                  in cart.get_lines_prices(**pricing_context)}
+
+        # match partitions with existing groups
+        unused = list(order.groups.prefetch_related('lines').order_by('pk'))
+        groups, new_groups, reused = [], [], set()
+        for partition in partitions:
+            matched = [group for group in unused if
+                       group.shipping_address_required == partition.is_shipping]
+            if matched:
+                group = matched[0]
+                unused = [i for i in unused if i is not group]
+                reused.add(id(group))
+            else:
+                group = order.build_delivery_group(partition)
+                new_groups.append(group)
+            groups.append(group)
+
+        if unused:
+            order.groups.filter(pk__in=[group.pk for group in unused]).delete()
+        if new_groups:
+            order.groups.model._default_manager.bulk_create(new_groups)
+        if any(group.pk is None for group in new_groups):
+            # db does not return primary keys, new groups are the last ones
+            created = list(order.groups.order_by('pk'))[-len(new_groups):]
+            created = dict(zip(map(id, new_groups), created))
+            groups = [created.get(id(group), group) for group in groups]
+
+        # match cart lines with existing lines of groups
+        new_lines, changed, stale = [], [], []
+        fields = ('quantity', 'unit_price_net', 'unit_price_gross', 'name',)
+        for delivery_group, partition in zip(groups, partitions):
+            existing = {}
+            if id(delivery_group) in reused:
+                for line in delivery_group.lines.all():
+                    existing.setdefault(line.variant_id, []).append(line)
             for cart_line in partition:
-                price = cart_line.get_price_per_item(cart=cart,
-                                                    **pricing_context)
-                delivery_group.create_order_line(cart_line.variant,
-                                                 cart_line.quantity, price)
+                price = prices.get(id(cart_line))
+                if price is None:
+                    price = cart_line.get_price_per_item(cart=cart,
+                                                         **pricing_context)
+                line = delivery_group.build_order_line(
+                    cart_line.variant, cart_line.quantity, price)
+                current = existing.get(cart_line.variant_id)
+                if not current:
+                    new_lines.append(line)
+                    continue
+                current = current.pop(0)
+                for name in fields:
+                    if getattr(current, name) != getattr(line, name):
+                        setattr(current, name, getattr(line, name))
+                        changed.append((current, name,))
+            stale.extend(line for lines in existing.values() for line in lines)
+
+        if not groups:
+            return
+        lines = groups[0].lines.model._default_manager
+        if stale:
+            lines.filter(pk__in=[line.pk for line in stale]).delete()
+        if new_lines:
+            lines.bulk_create(new_lines)
+        now = timezone.now()
+        for name in fields:
+            update_by_pk(lines.all(), name, {
+                line.pk: getattr(line, name)
+                for line, field_name in changed if field_name == name
+            }, date_update=now)
 
     def clear_inactive_orders(self, order, cart, user=None):
         self.Order.objects.filter(
@@ -80,18 +170,23 @@ class CheckoutApp(ShopKitApp):
 
     def check_order(self, order, check_quantity=True):
         # check order and validate it for empty and empty groups
-        checked = (order and not order.is_empty() and
-                   not order.groups.filter(lines__isnull=True).exists())
+        checked = (order and not order.is_outdated() and
+                   not order.is_empty() and not order.has_empty_groups())
         # check quantities if check_quantity is set
         if checked and check_quantity:
             checked = order.check_lines_quantities()
 
         return checked
 
-    def redirect_order(self, order):
-        if not order or order.is_empty():
+    def redirect_order(self, order, checked=None):
+        """
+        Redirect to order's current step, `checked` is check_order result
+        if it was computed before (e.g. by CheckoutContext).
+        """
+        if not order or order.is_empty() or order.is_outdated():
             return self.shop_app.cart_app.redirect('details')
-        elif order.status == order.SC.CHECKOUT and not self.check_order(order):
+        elif order.status == order.SC.CHECKOUT and not (
+                self.check_order(order) if checked is None else checked):
             return self.redirect('fix-order-lines', order_token=order.token)
         elif order.status == order.SC.CHECKOUT:
             return self.redirect('checkout', order_token=order.token)
@@ -149,6 +244,9 @@ class CheckoutApp(ShopKitApp):
         if not self.shop_app.cart_app.check_cart(cart):
             return self.shop_app.cart_app.redirect('fix-cart-lines')
 
+        # save cart to db if its lines are kept in other storage (cache)
+        cart.materialize()
+
         # get order by cart or create from cart and after check it
         order = self.get_order_from_cart(request, cart)
         if not self.check_order(order):
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from django.utils.functional import cached_property
+
+
+class CheckoutContext(object):
+    """
+    Order of checkout step with all its delivery groups, lines and variants
+    loaded once per request (see CheckoutApp.order_prefetch_related) and
+    memoized validation results, passed to checkout step methods and used
+    for forms querysets, so each step makes a handful of queries.
+    """
+
+    def __init__(self, checkout_app, request, order_token):
+        self.checkout_app = checkout_app
+        self.request = request
+        self.order_token = order_token
+        self._checks = {}
+
+    @cached_property
+    def order(self):
+        orders = self.checkout_app.get_order_queryset(self.request)
+        orders = orders.prefetch_related(
+            *self.checkout_app.order_prefetch_related)
+        return orders.filter(token=self.order_token).first()
+
+    @property
+    def groups(self):
+        return self.order.get_groups() if self.order else []
+
+    @property
+    def lines(self):
+        return self.order.get_lines() if self.order else []
+
+    def check_order(self, check_quantity=True):
+        """Memoized CheckoutApp.check_order result."""
+        if check_quantity not in self._checks:
+            self._checks[check_quantity] = self.checkout_app.check_order(
+                self.order, check_quantity=check_quantity)
+        return self._checks[check_quantity]
+
+    def is_checkout(self):
+        """Is order valid and still in checkout status."""
+        return bool(self.check_order() and
+                    self.order.status == self.order.SC.CHECKOUT)
+
+    def redirect_order(self):
+        """Redirect to order's current step (see CheckoutApp)."""
+        return self.checkout_app.redirect_order(
+            self.order, checked=self._checks.get(True))
+
+    def filter_groups(self, **filters):
+        """
+        Return list of order's loaded delivery groups (matching `filters`
+        values exactly) ordered by pk, used for model formsets without
+        extra queries (see shopkit.order.forms.DeliveryGroupFormSet).
+        """
+        groups = [group for group in self.groups
+                  if all(getattr(group, name) == value
+                         for name, value in filters.items())]
+        return sorted(groups, key=lambda group: group.pk)
@@ -49,6 +49,7 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         self.ShippingFormSet = (
             self.ShippingFormSet or
             modelformset_factory(self.ShippingForm._meta.model,
+                                 formset=forms.DeliveryGroupFormSet,
                                  form=self.ShippingForm, extra=0))
         self.DeliveryMethodFormSet = (
             self.DeliveryMethodFormSet or
@@ -82,15 +83,16 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         Otherwise redirect to step 2.
         (next step is "delivery-method", previous step is "prepare-order")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
 
         billing_form = self.BillingForm(
             data=request.POST or None, instance=order)
         shipping_formset = self.ShippingFormSet(
             data=request.POST or None,
-            queryset=order.groups.filter(shipping_address_required=True))
+            queryset=checkout.filter_groups(shipping_address_required=True))
 
         if billing_form.is_valid() and shipping_formset.is_valid():
             order = billing_form.save()
@@ -98,7 +100,7 @@ class MultiStepCheckoutApp(app.CheckoutApp):
             return self.redirect('delivery-method', order_token=order.token)
 
         context = self.get_context_data(
-            request, order=order, billing_form=billing_form,
+            request, order=order, checkout=checkout, billing_form=billing_form,
             shipping_formset=shipping_formset)
         return render(request, self.checkout_templates, context)
 
@@ -108,12 +110,14 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         User chooses delivery method for each of the delivery groups.
         (next step is "delivery-details", previous step is "checkout")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
 
         delivery_method_formset = self.DeliveryMethodFormSet(
-            data=request.POST or None, queryset=order.groups.all(),
+            data=request.POST or None,
+            queryset=checkout.filter_groups(),
             delivery_queue=self.delivery_queue)
 
         if delivery_method_formset.is_valid():
@@ -121,7 +125,7 @@ class MultiStepCheckoutApp(app.CheckoutApp):
             return self.redirect('delivery-details', order_token=order.token)
 
         context = self.get_context_data(
-            request, order=order,
+            request, order=order, checkout=checkout,
             delivery_method_formset=delivery_method_formset)
         return render(request, self.delivery_method_templates, context)
 
@@ -131,10 +135,11 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         User supplies further delivery details if needed.
         (next step is "payment-method", previous step is "delivery-method")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
-        delivery_groups = order.groups.all()
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
+        delivery_groups = checkout.groups
         if not all([group.delivery_type for group in delivery_groups]):
             return self.redirect('delivery-method', order_token=order.token)
 
@@ -144,10 +149,12 @@ class MultiStepCheckoutApp(app.CheckoutApp):
                for group, delivery_type, form in delivery_group_forms):
             for group, delivery_type, form in delivery_group_forms:
                 self.delivery_queue.save(group, form)
+            order.update_totals(groups=delivery_groups)
             return self.redirect('payment-method', order_token=order.token)
 
         context = self.get_context_data(
-            request, order=order, delivery_group_forms=delivery_group_forms)
+            request, order=order, checkout=checkout,
+            delivery_group_forms=delivery_group_forms)
         return render(request, self.delivery_details_templates, context)
 
     def payment_method(self, request, order_token, **kwargs):
@@ -156,9 +163,10 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         User chooses the payment method.
         (next step is "payment-details", previous step is "delivery-details")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
 
         payment_form = self.PaymentMethodForm(
             data=request.POST or None, instance=order,
@@ -169,7 +177,8 @@ class MultiStepCheckoutApp(app.CheckoutApp):
             return self.redirect('payment-details', order_token=order.token)
 
         context = self.get_context_data(
-            request, order=order, payment_form=payment_form)
+            request, order=order, checkout=checkout,
+            payment_form=payment_form)
         return render(request, self.payment_method_templates, context)
 
     def payment_details(self, request, order_token, **kwargs):
@@ -179,9 +188,10 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         Otherwise we redirect to final confirmation step.
         (next step is "verification", previous step is "payment-method")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
         if not order.payment_type:
             return self.redirect('payment-method', order_token=order.token)
 
@@ -191,7 +201,8 @@ class MultiStepCheckoutApp(app.CheckoutApp):
             self.payment_queue.save(order, form=form)
             return self.redirect('verification', order_token=order.token)
 
-        context = self.get_context_data(request, form=form, order=order)
+        context = self.get_context_data(request, form=form, order=order,
+                                        checkout=checkout)
         return render(request, self.payment_details_templates, context)
 
     def verification(self, request, order_token, **kwargs):
@@ -201,12 +212,13 @@ class MultiStepCheckoutApp(app.CheckoutApp):
         we are ready to change order status and redirect to confirmation page.
         (next step is "confirmation", previous step is "payment-details")
         """
-        order = self.get_order(request, order_token)
-        if not self.check_order(order) or order.status != order.SC.CHECKOUT:
-            return self.redirect_order(order)
+        checkout = self.get_checkout_context(request, order_token)
+        if not checkout.is_checkout():
+            return checkout.redirect_order()
+        order = checkout.order
 
         # delivery and payment data check
-        if not all([group.delivery_type for group in order.groups.all()]):
+        if not all([group.delivery_type for group in checkout.groups]):
             return self.redirect('delivery-method', order_token=order.token)
         if not order.payment_type:
             return self.redirect('payment-method', order_token=order.token)
@@ -222,5 +234,6 @@ class MultiStepCheckoutApp(app.CheckoutApp):
                 return self.redirect_order(order)
             return self.redirect('confirmation', order_token=order.token)
 
-        context = self.get_context_data(request, order=order, form=form)
+        context = self.get_context_data(request, order=order, form=form,
+                                        checkout=checkout)
         return render(request, self.verification_templates, context)
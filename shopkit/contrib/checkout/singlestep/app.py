@@ -70,6 +70,7 @@ class SingleStepCheckoutApp(app.CheckoutApp):
                 for group, typ, form in delivery_group_forms:
                     self.delivery_queue.save(group, form)
                 self.payment_queue.save(order, payment_form)
+                order.update_totals()
                 order.set_status(order.SC.PAYMENT_PENDING)
                 return self.redirect('confirmation', order_token=order.token)
 
@@ -0,0 +1,19 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from ...models import OrderStockReservationMixin
+
+
+class Command(BaseCommand):
+    help = 'Release (delete) all expired stock reservations.'
+
+    def get_reservation_models(self):
+        """Reservation models of all order models with reservations."""
+        return set(model.get_stock_reservation_model()
+                   for model in apps.get_models()
+                   if issubclass(model, OrderStockReservationMixin))
+
+    def handle(self, *args, **options):
+        count = 0
+        for model in self.get_reservation_models():
+            count += model.objects.expired().delete()[0]
+        self.stdout.write('Released %d expired stock reservations.' % count)
@@ -0,0 +1,96 @@
+from django.db import models
+from django.db.models import F, Sum
+from django.utils import timezone
+from ..singlestore.managers import (VariantStockLevelQuerySet,
+                                    VariantStockLevelManager)
+
+
+class StockReservationQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(date_expire__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(date_expire__lte=timezone.now())
+
+    def exclude_owners(self, order=None, cart=None):
+        """Exclude holds of order lines of given order or cart orders."""
+        queryset = self
+        if order is not None:
+            queryset = queryset.exclude(order_line__delivery_group__order=order)
+        if cart is not None and cart.pk:
+            queryset = queryset.exclude(
+                order_line__delivery_group__order__cart=cart)
+        return queryset
+
+    def get_reserved(self, variant_ids):
+        """Return {variant_id: reserved quantity} with single query."""
+        reserved = self.filter(variant__in=variant_ids).order_by()
+        reserved = reserved.values('variant').annotate(total=Sum('quantity'))
+        return dict(reserved.values_list('variant', 'total'))
+
+
+class StockReservationManager(models.Manager):
+    queryset_class = StockReservationQuerySet
+
+    def get_queryset(self):
+        return self.queryset_class(self.model, using=self._db)
+
+    def active(self):
+        return self.get_queryset().active()
+
+    def expired(self):
+        return self.get_queryset().expired()
+
+
+class VariantStockReservationQuerySet(VariantStockLevelQuerySet):
+    def check_quantities(self, quantities, exclude_order=None,
+                         exclude_cart=None):
+        """
+        Check requested quantities against available stock (stock level
+        minus active holds) with two queries, holds of exclude_order and
+        of exclude_cart orders are not counted.
+        """
+        if not quantities:
+            return {}
+        reservations = self.model._meta.get_field(
+            'stock_reservations').related_model._default_manager
+        reserved = reservations.active().exclude_owners(order=exclude_order,
+                                                         cart=exclude_cart)
+        reserved = reserved.get_reserved(quantities.keys())
+        stocks = self.filter(pk__in=quantities.keys())
+        stocks = {pk: max(stock - reserved.get(pk, 0), 0) for pk, stock
+                  in stocks.values_list('pk', 'stock_level')}
+        return {pk: stocks.get(pk, 0) for pk, quantity in quantities.items()
+                if quantity > stocks.get(pk, 0)}
+
+    def take_quantity(self, pk, quantity):
+        """
+        Atomically take quantity of variant from available stock (stock
+        level minus active holds), returns taken value.
+
+        Variant row is locked before holds are counted, so concurrent takes
+        and reservations (which lock variants too) can not use the same
+        stock. Holds of taking order should be released before (see
+        OrderStockReservationMixin.stock_handler). Should be called inside
+        transaction.
+        """
+        if not quantity:
+            return 0
+        stock = (self.select_for_update().filter(pk=pk)
+                     .values_list('stock_level', flat=True).first())
+        if not stock:
+            return 0
+        reservations = self.model._meta.get_field(
+            'stock_reservations').related_model._default_manager
+        reserved = reservations.active().get_reserved([pk]).get(pk, 0)
+        taken = min(quantity, max(stock - reserved, 0))
+        if taken:
+            self.filter(pk=pk).update(stock_level=F('stock_level') - taken)
+        return taken
+
+
+class VariantStockReservationManager(VariantStockLevelManager):
+    queryset_class = VariantStockReservationQuerySet
+
+    def check_quantities(self, quantities, **kwargs):
+        return self.get_queryset().check_quantities(quantities, **kwargs)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import datetime
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+from ..singlestore.models import VariantStockLevelMixin, OrderStockLevelMixin
+from . import managers
+
+
+class StockReservation(models.Model):
+    """
+    Time-limited hold of variant's stock for an order line.
+
+    Holds are created during checkout (see OrderStockReservationMixin) and
+    are counted as unavailable stock until expiration, expired holds are
+    ignored and may be removed by "releasestock" management command.
+    """
+
+    order_line = models.OneToOneField(
+        'orders.OrderLine', editable=False, on_delete=models.CASCADE,
+        related_name='stock_reservation')
+    variant = models.ForeignKey(
+        'products.Variant', editable=False, on_delete=models.CASCADE,
+        related_name='stock_reservations')
+
+    quantity = models.PositiveIntegerField(_('quantity'), default=0)
+
+    date_create = models.DateTimeField(editable=False, auto_now_add=True)
+    date_expire = models.DateTimeField(editable=False, db_index=True)
+
+    objects = managers.StockReservationManager()
+
+    class Meta:
+        abstract = True
+
+    def __unicode__(self):
+        return u'%s × %d' % (self.variant, self.quantity,)
+
+
+class VariantStockReservationMixin(VariantStockLevelMixin):
+    """
+    Mixin for configurable Variant models with stock and reservations.
+
+    Available stock is stock level minus all active holds, so
+    check_quantity and manager's check_quantities use available stock.
+    Cart and order checks exclude their own holds (exclude_cart and
+    exclude_order arguments of check_quantities), so stock checks of
+    customer's lines should go through cart or order methods
+    (e.g. Cart.check_variant_quantity), not through check_quantity.
+    """
+
+    objects = managers.VariantStockReservationManager()
+
+    class Meta:
+        abstract = True
+
+    def get_stock(self):
+        reserved = self.stock_reservations.active().get_reserved([self.pk])
+        return max(self.stock_level - reserved.get(self.pk, 0), 0)
+
+
+class CartStockReservationMixin(models.Model):
+    """
+    Mixin for configurable Cart models.
+
+    Holds of cart's orders are not counted on cart lines quantities check.
+    """
+
+    class Meta:
+        abstract = True
+
+    def get_insufficient_lines(self, lines=None, **kwargs):
+        kwargs.setdefault('exclude_cart', self)
+        return super(CartStockReservationMixin,
+                     self).get_insufficient_lines(lines=lines, **kwargs)
+
+
+class OrderStockReservationMixin(OrderStockLevelMixin):
+    """
+    Mixin for configurable Order models.
+
+    Allow to hold stock for order lines while checkout is in progress,
+    holds are replaced by real stock substruction on stock_handler "take".
+    Holds lifetime is defined in SATCHLESS_STOCK_RESERVATION_TIMEOUT
+    setting (in minutes, 15 by default).
+    """
+
+    # expiration date of the last reservation (even if nothing was held)
+    stock_reserved_until = models.DateTimeField(
+        _('stock reserved until'), blank=True, null=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_stock_reservation_model(cls):
+        lines = cls._meta.get_field('groups').related_model
+        lines = lines._meta.get_field('lines').related_model
+        return lines._meta.get_field('stock_reservation').related_model
+
+    def get_stock_reservation_timeout(self):
+        return datetime.timedelta(minutes=getattr(
+            settings, 'SATCHLESS_STOCK_RESERVATION_TIMEOUT', 15))
+
+    def check_lines_quantities(self, **kwargs):
+        kwargs.setdefault('exclude_order', self)
+        return super(OrderStockReservationMixin,
+                     self).check_lines_quantities(**kwargs)
+
+    def fix_lines_quantities(self, **kwargs):
+        kwargs.setdefault('exclude_order', self)
+        return super(OrderStockReservationMixin,
+                     self).fix_lines_quantities(**kwargs)
+
+    def reserve_stock(self):
+        """
+        Replace order holds by new ones for all order lines.
+
+        Variants are locked in id order, available quantities are computed
+        with single query and holds are created with single insert.
+        Reservation expiration date is stored in stock_reserved_until.
+        Lines missing quantities are stored in stock_shortfalls, returns
+        True if all lines are fully reserved.
+        """
+        lines = sorted(self.get_lines(),
+                       key=lambda line: (line.variant_id, line.pk))
+        self.stock_shortfalls = {}
+        date_expire = timezone.now() + self.get_stock_reservation_timeout()
+        if not lines:
+            self.set_stock_reserved_until(date_expire)
+            return True
+
+        reservations = self.get_stock_reservation_model()
+        variants = type(lines[0])._meta.get_field(
+            'variant').related_model._default_manager
+        variant_ids = sorted(set(line.variant_id for line in lines
+                                 if line.variant_id))
+
+        with transaction.atomic():
+            reservations.objects.filter(
+                order_line__delivery_group__order=self).delete()
+            available = variants.select_for_update().filter(
+                pk__in=variant_ids).order_by('pk')
+            available = dict(available.values_list('pk', 'stock_level'))
+            reserved = reservations.objects.active().get_reserved(variant_ids)
+
+            holds = []
+            for line in lines:
+                stock = max(available.get(line.variant_id, 0) -
+                            reserved.get(line.variant_id, 0), 0)
+                quantity = min(line.quantity, stock)
+                if quantity:
+                    available[line.variant_id] -= quantity
+                    holds.append(reservations(
+                        order_line=line, variant_id=line.variant_id,
+                        quantity=quantity, date_expire=date_expire))
+                if quantity < line.quantity:
+                    self.stock_shortfalls[line.pk] = line.quantity - quantity
+            reservations.objects.bulk_create(holds)
+            self.set_stock_reserved_until(date_expire)
+
+        return not self.stock_shortfalls
+
+    def is_stock_reserved(self):
+        """Is order reservation not expired yet (no queries)."""
+        return bool(self.stock_reserved_until and
+                    self.stock_reserved_until > timezone.now())
+
+    def set_stock_reserved_until(self, date):
+        self.stock_reserved_until = date
+        if self.pk:
+            type(self)._default_manager.filter(pk=self.pk).update(
+                stock_reserved_until=date)
+
+    def release_stock(self):
+        """Remove all order holds with single query."""
+        reservations = self.get_stock_reservation_model()
+        reservations.objects.filter(
+            order_line__delivery_group__order=self).delete()
+        if self.stock_reserved_until is not None:
+            self.set_stock_reserved_until(None)
+
+    def stock_handler(self, action=None, check_quantity=True):
+        """Release order holds before stock taking (in same transaction)."""
+        with transaction.atomic():
+            if action == 'take' and self.stock_state == self.STOCK_FREE:
+                self.release_stock()
+            result = super(OrderStockReservationMixin, self).stock_handler(
+                action=action, check_quantity=check_quantity)
+            if not result:
+                transaction.set_rollback(True)
+        return result
@@ -0,0 +1,64 @@
+from django.db import models
+from django.db.models import F
+
+
+class VariantStockLevelQuerySet(models.QuerySet):
+    def check_quantities(self, quantities):
+        """
+        Check requested quantities ({variant_id: quantity}) against variants
+        stock levels with single query.
+
+        Returns shortfalls dict {variant_id: stock_level} for each variant
+        with stock level less than requested quantity (missing variants are
+        considered as variants with zero stock level).
+        """
+        if not quantities:
+            return {}
+        stocks = dict(self.filter(pk__in=quantities.keys())
+                          .values_list('pk', 'stock_level'))
+        return {pk: stocks.get(pk, 0) for pk, quantity in quantities.items()
+                if quantity > stocks.get(pk, 0)}
+
+    def take_quantity(self, pk, quantity):
+        """
+        Atomically take quantity of variant from stock, returns taken value.
+
+        Stock level is decreased by conditional update (only if stock level
+        is enough), if it is not, variant row is locked and all remaining
+        stock is taken, so stock level never becomes negative and concurrent
+        updates are never lost. Should be called inside transaction.
+        """
+        if not quantity:
+            return 0
+        if self.filter(pk=pk, stock_level__gte=quantity).update(
+                stock_level=F('stock_level') - quantity):
+            return quantity
+
+        stock = (self.select_for_update().filter(pk=pk)
+                     .values_list('stock_level', flat=True).first())
+        if stock:
+            self.filter(pk=pk).update(stock_level=F('stock_level') - stock)
+        return stock or 0
+
+    def free_quantity(self, pk, quantity):
+        """Atomically return quantity of variant to stock."""
+        if not quantity:
+            return 0
+        self.filter(pk=pk).update(stock_level=F('stock_level') + quantity)
+        return quantity
+
+
+class VariantStockLevelManager(models.Manager):
+    queryset_class = VariantStockLevelQuerySet
+
+    def get_queryset(self):
+        return self.queryset_class(self.model, using=self._db)
+
+    def check_quantities(self, quantities):
+        return self.get_queryset().check_quantities(quantities)
+
+    def take_quantity(self, pk, quantity):
+        return self.get_queryset().take_quantity(pk, quantity)
+
+    def free_quantity(self, pk, quantity):
+        return self.get_queryset().free_quantity(pk, quantity)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import MaxValueValidator, MinValueValidator
 from satchless.item import StockedItem
+from ....utils import update_by_pk
+from . import managers
 
 
 class VariantStockLevelMixin(models.Model, StockedItem):
@@ -15,12 +17,18 @@ class VariantStockLevelMixin(models.Model, StockedItem):
 
     Raises satchless.item.InsufficientStock exception by check_quantity
     if requested quantity less than variant's stock_level.
+
+    Manager provides check_quantities method to check stock levels of
+    many variants with single query (used by cart and order to check and
+    fix lines quantities).
     """
 
     stock_level = models.PositiveIntegerField(
         _("stock level"), default=0,
         validators=[MinValueValidator(0), MaxValueValidator(999),])
 
+    objects = managers.VariantStockLevelManager()
+
     class Meta:
         abstract = True
 
@@ -47,36 +55,54 @@ class OrderStockLevelMixin(models.Model):
         _("stock state"), max_length=32,
         choices=STOCK_STATE_CHOICES, default=STOCK_FREE)
 
+    # {line.pk: missing quantity} filled by the last stock_handler call
+    stock_shortfalls = None
+
     class Meta:
         abstract = True
 
     def stock_handler(self, action=None, check_quantity=True):
-        if action == 'take':
-            if self.stock_state == self.STOCK_TAKEN:
-                return True
-
-            # check quantity if required
-            if check_quantity and not self.check_lines_quantities():
-                return False
-
-            for group in self.groups.all():
-                for line in group.lines.all():
-                    line.stock_handler(action='take')
-
-        elif action == 'free':
-            if self.stock_state == self.STOCK_FREE:
-                return True
-
-            for group in self.groups.all():
-                for line in group.lines.all():
-                    line.stock_handler(action='free')
-
-        else:
+        """
+        Take all order lines from stock or free them in single transaction.
+
+        Stock state is switched by conditional update, so concurrent calls
+        can not take (or free) stock twice, variants stock levels are
+        changed atomically in variant id order (deterministic lock order
+        prevents deadlocks between concurrent orders). Lines missing
+        quantities are stored in stock_shortfalls, if any line is short and
+        check_quantity is set, all changes are rolled back and False is
+        returned, otherwise available quantities are taken.
+        """
+        states = {'take': (self.STOCK_FREE, self.STOCK_TAKEN),
+                  'free': (self.STOCK_TAKEN, self.STOCK_FREE),}
+        if action not in states:
             return False
 
-        self.stock_state = action
-        self.save()
-
+        old_state, new_state = states[action]
+        lines = sorted(self.get_lines(),
+                       key=lambda line: (line.variant_id, line.pk))
+        self.stock_shortfalls = {}
+
+        with transaction.atomic():
+            orders = type(self)._default_manager.filter(pk=self.pk,
+                                                        stock_state=old_state)
+            if orders.update(stock_state=new_state):
+                for line in lines:
+                    delta = line.stock_handler(action=action, commit=False)
+                    if delta < 0:
+                        self.stock_shortfalls[line.pk] = -delta
+
+                if self.stock_shortfalls and check_quantity:
+                    transaction.set_rollback(True)
+                    return False
+
+                if lines:
+                    update_by_pk(
+                        type(lines[0])._default_manager.all(),
+                        'stock_level_taken',
+                        {line.pk: line.stock_level_taken for line in lines})
+
+        self.stock_state = new_state
         return True
 
 
@@ -86,7 +112,7 @@ class OrderLineStockLevelMixin(models.Model):
 
     Store substructed stock level in db and inform if missing items when
     stock_handler was called.
-    Variant model should be inherited from StockedItem class.
+    Variant model should be inherited from VariantStockLevelMixin class.
     """
 
     stock_level_taken = models.PositiveIntegerField(
@@ -96,42 +122,41 @@ class OrderLineStockLevelMixin(models.Model):
     class Meta:
         abstract = True
 
-    def stock_handler(self, action=None):
+    def stock_handler(self, action=None, commit=True):
         """
         Stock level handler for OrderLine configurable class.
 
         Returns quantity_delta after taking of refunding values from stock.
         Negative quantity_delta means not all items was in stock when handler
-        was called, it is possible only on "take" action.
+        was called (all available items are taken), it is possible only on
+        "take" action, zero means all items are taken.
         If None was returned, nothing was happend.
+        If commit is False, stock_level_taken value is not saved (order
+        stock_handler saves values of all lines with single query).
         """
 
         # should be called only from order
-        quantity_delta = None
-        stock_level = self.variant.get_stock()
-        stock_level_taken = self.stock_level_taken
+        variants = self._meta.get_field('variant').related_model
+        variants = variants._default_manager
 
         if action == 'take':
-            quantity_delta = stock_level - self.quantity
-            if quantity_delta < 0:
-                stock_level_taken = stock_level
-                stock_level = 0
-            else:
-                stock_level_taken = self.quantity
-                stock_level -= self.quantity
+            stock_level_taken = (
+                variants.take_quantity(self.variant_id, self.quantity)
+                if self.variant_id else 0)
+            quantity_delta = stock_level_taken - self.quantity
 
         elif action == 'free':
-            quantity_delta = stock_level_taken
-            stock_level += stock_level_taken
+            if self.variant_id:
+                variants.free_quantity(self.variant_id,
+                                       self.stock_level_taken)
+            quantity_delta = self.stock_level_taken
             stock_level_taken = 0
 
         else:
-            return quantity_delta
-
-        self.variant.stock_level = stock_level
-        self.variant.save()
+            return None
 
         self.stock_level_taken = stock_level_taken
-        self.save()
+        if commit:
+            self.save(update_fields=['stock_level_taken'])
 
         return quantity_delta
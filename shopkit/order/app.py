@@ -1,5 +1,8 @@
 from django.contrib.auth.decorators import login_required
+from django.db.models import Q
+from django.http import Http404
 from django.shortcuts import get_object_or_404, render
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
 from django.conf.urls import url
 from ..core.app import ShopKitApp
@@ -13,6 +16,7 @@ class OrderApp(ShopKitApp):
     Order = None
     DeliveryGroup = None
     OrderLine = None
+    ArchivedOrder = None  # optional, details fall back to archived orders
 
     order_list_templates = [
         'shopkit/order/list.html',
@@ -21,6 +25,11 @@ class OrderApp(ShopKitApp):
         'shopkit/order/view.html',
     ]
 
+    # order history page size and related objects loaded with its orders
+    # (summary columns are denormalised, see Order.update_totals)
+    orders_per_page = 20
+    order_list_prefetch_related = ('groups__lines',)
+
     def __init__(self, **kwargs):
         super(OrderApp, self).__init__(**kwargs)
         assert self.Order and self.DeliveryGroup and self.OrderLine, (
@@ -33,6 +42,80 @@ class OrderApp(ShopKitApp):
             user=request.user if request.user.is_authenticated else None)
         return get_object_or_404(orders, token=order_token)
 
+    def get_archived_order(self, request, order_token):
+        """
+        Return (order, groups) restored from archive (see
+        ArchivedOrder.get_order) or None, if order is not archived or
+        archive is not used.
+        """
+        if not self.ArchivedOrder:
+            return None
+        archived = self.ArchivedOrder.objects.filter(
+            user=request.user if request.user.is_authenticated else None,
+            token=order_token).first()
+        return archived and archived.get_order(self.Order)
+
+    def get_order_groups(self, order):
+        """
+        Return list of (delivery group, lines) pairs of order, loaded with
+        single query per model (see Order.get_groups).
+        """
+        return [(group, list(group.lines.all()))
+                for group in order.get_groups()]
+
+    def get_orders_queryset(self, request):
+        return self.Order.objects.filter(user=request.user)
+
+    def get_page_cursor(self, order):
+        """Return keyset pagination cursor of order."""
+        return '%s_%d' % (order.date_last_status_change.isoformat(),
+                          order.pk,)
+
+    def parse_page_cursor(self, cursor):
+        """Return (date_last_status_change, id) of cursor or raise 404."""
+        date, sep, pk = cursor.rpartition('_')
+        date = parse_datetime(date) if sep and pk.isdigit() else None
+        if not date:
+            raise Http404('Invalid page cursor.')
+        return date, int(pk)
+
+    def get_orders_page(self, request, after=None, before=None):
+        """
+        Return (orders, previous cursor, next cursor) of order history page
+        with keyset pagination on (date_last_status_change, id): page is
+        selected by index range scan from cursor, so deep pages cost the
+        same as the first one. Cursors are None on first and last pages.
+        """
+        orders = self.get_orders_queryset(request)
+        cursor = after or before
+        if cursor:
+            date, pk = self.parse_page_cursor(cursor)
+            if after:
+                orders = orders.filter(
+                    Q(date_last_status_change__lt=date) |
+                    Q(date_last_status_change=date, id__lt=pk))
+            else:
+                orders = orders.filter(
+                    Q(date_last_status_change__gt=date) |
+                    Q(date_last_status_change=date, id__gt=pk))
+
+        ordering = ('-date_last_status_change', '-id',)
+        if before:
+            ordering = ('date_last_status_change', 'id',)
+        size = self.orders_per_page
+        orders = list(orders.order_by(*ordering).prefetch_related(
+            *self.order_list_prefetch_related)[:size + 1])
+
+        more, orders = len(orders) > size, orders[:size]
+        if before:
+            orders.reverse()
+        previous_cursor = next_cursor = None
+        if orders and (after or (before and more)):
+            previous_cursor = self.get_page_cursor(orders[0])
+        if orders and (before or more):
+            next_cursor = self.get_page_cursor(orders[-1])
+        return orders, previous_cursor, next_cursor
+
     # Views methods section
     # ---------------------
     def get_urls(self):
@@ -44,11 +127,26 @@ class OrderApp(ShopKitApp):
 
     @method_decorator(login_required)
     def index(self, request, **kwargs):
-        orders = self.Order.objects.filter(user=request.user)
-        context = self.get_context_data(request, orders=orders)
+        orders, previous_cursor, next_cursor = self.get_orders_page(
+            request, after=request.GET.get('after'),
+            before=request.GET.get('before'))
+        context = self.get_context_data(
+            request, orders=orders, previous_cursor=previous_cursor,
+            next_cursor=next_cursor)
         return render(request, self.order_list_templates, context)
 
     def details(self, request, order_token, **kwargs):
-        order = self.get_order(request, order_token=order_token)
-        context = self.get_context_data(request, order=order)
+        archived = False
+        try:
+            order = self.get_order(request, order_token=order_token)
+            groups = self.get_order_groups(order)
+        except Http404:
+            restored = self.get_archived_order(request,
+                                               order_token=order_token)
+            if not restored:
+                raise
+            order, groups = restored
+            archived = True
+        context = self.get_context_data(request, order=order, groups=groups,
+                                        archived=archived)
         return render(request, self.order_details_templates, context)
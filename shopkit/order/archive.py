@@ -0,0 +1,114 @@
+import datetime
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from prices import Price
+
+
+class ArchiveJSONEncoder(DjangoJSONEncoder):
+    """Encode datetimes with full precision."""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(ArchiveJSONEncoder, self).default(o)
+
+
+def get_related_models(order_model):
+    """Return (delivery group, order line, status event) models of order."""
+    group_model = order_model._meta.get_field('groups').related_model
+    line_model = group_model._meta.get_field('lines').related_model
+    event_model = order_model._meta.get_field('status_events').related_model
+    return group_model, line_model, event_model
+
+
+def get_unarchived_lookups(order_model):
+    """
+    Return lookups (from order) of reverse relations of order, its groups,
+    lines and status events other than archived ones (e.g. payment variants
+    or stock reservations), such objects would be deleted with order.
+    """
+    group_model, line_model, event_model = get_related_models(order_model)
+    lookups = []
+    for model, prefix, archived in (
+            (order_model, '', ('groups', 'status_events',)),
+            (group_model, 'groups__', ('lines',)),
+            (line_model, 'groups__lines__', ()),
+            (event_model, 'status_events__', ())):
+        lookups.extend(prefix + relation.name
+                       for relation in model._meta.related_objects
+                       if relation.name not in archived)
+    return lookups
+
+
+def get_values(queryset):
+    """
+    Yield values of all concrete fields of queryset's objects, prices
+    (tuples, not handled by JSON encoder) are replaced by amounts.
+    """
+    names = [field.attname for field in queryset.model._meta.concrete_fields]
+    for values in queryset.order_by('pk').values(*names):
+        for name, value in values.items():
+            if isinstance(value, Price):
+                values[name] = value.net
+        yield values
+
+
+def dump_orders(order_model, pks):
+    """
+    Return list of orders (with pks) data: values of all concrete fields
+    with nested "groups" (each with "lines") and "status_events" values,
+    loaded with single query per model.
+    """
+    group_model, line_model, event_model = get_related_models(order_model)
+
+    lines, groups, events = {}, {}, {}
+    for line in get_values(line_model._default_manager.filter(
+            delivery_group__order_id__in=pks)):
+        lines.setdefault(line['delivery_group_id'], []).append(line)
+    for group in get_values(group_model._default_manager.filter(
+            order_id__in=pks)):
+        group['lines'] = lines.get(group['id'], [])
+        groups.setdefault(group['order_id'], []).append(group)
+    for event in get_values(event_model._default_manager.filter(
+            order_id__in=pks)):
+        events.setdefault(event['order_id'], []).append(event)
+
+    orders = list(get_values(order_model._default_manager.filter(
+        pk__in=pks)))
+    for order in orders:
+        order['groups'] = groups.get(order['id'], [])
+        order['status_events'] = events.get(order['id'], [])
+    return orders
+
+
+def dumps_order(data):
+    return json.dumps(data, cls=ArchiveJSONEncoder, sort_keys=True)
+
+
+def load_object(model, data):
+    """Return unsaved model instance by dumped (JSON decoded) values."""
+    return model(**{
+        field.attname: field.to_python(data[field.attname])
+        for field in model._meta.concrete_fields if field.attname in data})
+
+
+def load_order(order_model, data):
+    """
+    Return order restored from dumped data (see dump_orders), not saved,
+    and list of its (delivery group, lines) pairs, so it can be rendered
+    as regular order without queries (see OrderApp.get_order_groups).
+    Status events are not restored.
+    """
+    group_model, line_model, event_model = get_related_models(order_model)
+
+    order = load_object(order_model, data)
+    order._state.adding = False
+    groups = []
+    for group_data in data.get('groups', []):
+        group = load_object(group_model, group_data)
+        group.order = order
+        lines = [load_object(line_model, line) for line in group_data['lines']]
+        for line in lines:
+            line.delivery_group = group
+        groups.append((group, lines,))
+    return order, groups
@@ -41,7 +41,19 @@ class DeliveryMethodForm(forms.ModelForm):
         self.fields['delivery_type'].choices = types
 
 
-class DeliveryMethodFormSet(BaseModelFormSet):
+class DeliveryGroupFormSet(BaseModelFormSet):
+    """
+    Model formset of delivery groups, `queryset` may be a list of already
+    loaded groups (see CheckoutContext.filter_groups), so no queries are
+    made for formset instances.
+    """
+    def get_queryset(self):
+        if isinstance(self.queryset, list):
+            return self.queryset
+        return super(DeliveryGroupFormSet, self).get_queryset()
+
+
+class DeliveryMethodFormSet(DeliveryGroupFormSet):
     def __init__(self, delivery_queue, *args, **kwargs):
         self.delivery_queue = delivery_queue
         super(DeliveryMethodFormSet, self).__init__(*args, **kwargs)
@@ -0,0 +1,99 @@
+import datetime
+import gzip
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from ...archive import dump_orders, dumps_order, get_unarchived_lookups
+
+
+class Command(BaseCommand):
+    help = ('Move orders in terminal statuses (delivered and cancelled by'
+            ' default), not changed for a long time, from live tables to'
+            ' archive table (or gzipped JSON Lines file) in small batches,'
+            ' each batch is committed separately. Orders with other related'
+            ' objects (e.g. payment variants or stock reservations), which'
+            ' would be deleted with them, are skipped.')
+
+    model = None  # order model
+    archive_model = None  # archived order model (not used with --output)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=365,
+            help='Archive orders with last status change older than days'
+                 ' (default 365).')
+        parser.add_argument(
+            '--status', action='append', default=[],
+            help='Archive orders with status only, may be repeated'
+                 ' (default delivered and cancelled).')
+        parser.add_argument(
+            '--output',
+            help='Append orders to gzipped JSON Lines file instead of'
+                 ' archive table (such orders are not available by'
+                 ' order details view).')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Count of orders archived in one transaction'
+                 ' (default 500).')
+        parser.add_argument(
+            '--sleep', type=float, default=0.1,
+            help='Pause between batches in seconds (default 0.1).')
+
+    def handle(self, *args, **options):
+        model = self.model
+        assert model, ('You need to subclass Command and provide model.')
+        assert self.archive_model or options['output'], (
+            'You need to subclass Command and provide archive_model.')
+        statuses = options['status'] or [model.SC.DELIVERED,
+                                         model.SC.CANCELLED]
+        unknown = set(statuses) - set(
+            dict(model._meta.get_field('status').flatchoices))
+        if unknown:
+            raise CommandError('Unknown status: %s.' % ', '.join(unknown))
+
+        archive_model = None if options['output'] else self.archive_model
+        output = options['output'] and gzip.open(options['output'], 'ab')
+
+        # archived orders are deleted, so they are not selected again
+        candidates = model._default_manager.filter(
+            status__in=statuses,
+            date_last_status_change__lt=timezone.now() - datetime.timedelta(
+                days=options['days'])).order_by('pk')
+        orders = candidates
+        for lookup in get_unarchived_lookups(model):
+            orders = orders.exclude(**{lookup + '__isnull': False})
+
+        total = 0
+        try:
+            while True:
+                with transaction.atomic(using=orders.db):
+                    pks = list(orders.select_for_update().values_list(
+                        'pk', flat=True)[:options['batch_size']])
+                    data = dump_orders(model, pks) if pks else []
+                    if output:
+                        # written before commit: orders of failed batch may
+                        # be written to file again by next run
+                        output.write(''.join(dumps_order(order) + '\n'
+                                             for order in data))
+                        output.flush()
+                    elif data:
+                        archive_model._default_manager.bulk_create([
+                            archive_model.build_from_data(order)
+                            for order in data])
+                    model._default_manager.filter(pk__in=pks).delete()
+                total += len(pks)
+                if options['verbosity'] > 1 and pks:
+                    self.stdout.write('Archived %d orders.' % total)
+                if len(pks) < options['batch_size']:
+                    break
+                time.sleep(options['sleep'])
+        finally:
+            if output:
+                output.close()
+
+        self.stdout.write('Archived %d orders.' % total)
+        skipped = candidates.count()
+        if skipped:
+            self.stdout.write('Skipped %d orders with other related objects.'
+                              % skipped)
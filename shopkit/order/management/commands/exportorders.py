@@ -0,0 +1,246 @@
+import csv
+import datetime
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.module_loading import import_string
+from prices import Price
+
+
+class BufferedWriter(object):
+    """Collect written data and pass it to `write` by blocks of `size`."""
+
+    def __init__(self, write, size):
+        self.write_block = write
+        self.size = size
+        self.buffer, self.length = [], 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.length += len(data)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write_block(''.join(self.buffer))
+            self.buffer, self.length = [], 0
+
+
+class Command(BaseCommand):
+    help = ('Export orders with delivery groups and lines to CSV (one row'
+            ' per order line) or JSON Lines (one order per line). Orders'
+            ' are read in chunks as plain values, so memory usage does not'
+            ' depend on count of exported orders.')
+
+    model = None  # order model, Order of shop's order app by default
+
+    # exported fields of orders, delivery groups and order lines
+    order_fields = (
+        'id', 'token', 'status', 'user_id', 'date_create',
+        'date_last_status_change', 'billing_first_name', 'billing_last_name',
+        'billing_company_name', 'billing_phone', 'billing_country',
+        'billing_country_area', 'billing_city', 'billing_postal_code',
+        'billing_street_address_1', 'billing_street_address_2',
+        'payment_type', 'payment_price', 'item_count', 'subtotal_net',
+        'subtotal_gross', 'delivery_total_net', 'delivery_total_gross',
+        'total_net', 'total_gross',)
+    group_fields = (
+        'id', 'delivery_type', 'delivery_price', 'shipping_first_name',
+        'shipping_last_name', 'shipping_company_name', 'shipping_phone',
+        'shipping_country', 'shipping_country_area', 'shipping_city',
+        'shipping_postal_code', 'shipping_street_address_1',
+        'shipping_street_address_2', 'item_count', 'total_net',
+        'total_gross',)
+    line_fields = (
+        'id', 'variant_id', 'name', 'quantity', 'unit_price_net',
+        'unit_price_gross',)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl',), default='csv',
+            help='Output format (default csv).')
+        parser.add_argument(
+            '--output', default='-',
+            help='Output file path (default "-", standard output).')
+        parser.add_argument(
+            '--since',
+            help='Export orders created at or after date (or datetime).')
+        parser.add_argument(
+            '--until',
+            help='Export orders created before date (or datetime).')
+        parser.add_argument(
+            '--status', action='append', default=[],
+            help='Export orders with status only, may be repeated.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Count of orders read with one query (default 2000).')
+        parser.add_argument(
+            '--buffer-size', type=int, default=256 * 1024,
+            help='Output buffer size in bytes (default 256 KiB).')
+
+    def get_model(self):
+        return self.model or import_string(
+            settings.SATCHLESS_SHOP_APP).order_app.Order
+
+    def parse_date(self, value):
+        date = parse_datetime(value)
+        if not date:
+            date = parse_date(value)
+            date = date and datetime.datetime.combine(date, datetime.time())
+        if not date:
+            raise CommandError('Invalid date value "%s".' % value)
+        if settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+    def get_orders(self, model, options):
+        orders = model._default_manager.all()
+        if options['since']:
+            orders = orders.filter(
+                date_create__gte=self.parse_date(options['since']))
+        if options['until']:
+            orders = orders.filter(
+                date_create__lt=self.parse_date(options['until']))
+        if options['status']:
+            statuses = dict(model._meta.get_field('status').flatchoices)
+            unknown = set(options['status']) - set(statuses)
+            if unknown:
+                raise CommandError('Unknown status: %s.' % ', '.join(unknown))
+            orders = orders.filter(status__in=options['status'])
+        return orders.values(*self.order_fields)
+
+    def iter_chunks(self, orders, chunk_size):
+        """
+        Yield lists of orders values by primary key ranges (keyset), so each
+        chunk is read with single short query independently of offset.
+        """
+        last = None
+        while True:
+            chunk = orders.order_by('pk')
+            if last is not None:
+                chunk = chunk.filter(pk__gt=last)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            yield chunk
+            last = chunk[-1]['id']
+            if len(chunk) < chunk_size:
+                break
+
+    def iter_orders(self, model, orders, chunk_size):
+        """Yield orders values with nested groups and lines values."""
+        group_model = model._meta.get_field('groups').related_model
+        line_model = group_model._meta.get_field('lines').related_model
+
+        for chunk in self.iter_chunks(orders, chunk_size):
+            pks = [order['id'] for order in chunk]
+            groups, lines = {}, {}
+            for line in line_model._default_manager.filter(
+                    delivery_group__order_id__in=pks).order_by('pk').values(
+                    'delivery_group_id', *self.line_fields):
+                lines.setdefault(line.pop('delivery_group_id'),
+                                 []).append(line)
+            for group in group_model._default_manager.filter(
+                    order_id__in=pks).order_by('pk').values(
+                    'order_id', *self.group_fields):
+                group['lines'] = lines.get(group['id'], [])
+                groups.setdefault(group.pop('order_id'), []).append(group)
+            for order in chunk:
+                order['groups'] = groups.get(order['id'], [])
+                yield order
+
+    def prepare_value(self, value):
+        if isinstance(value, Price):
+            return value.gross
+        return value
+
+    def prepare_values(self, values, fields):
+        return [self.prepare_value(values[name]) for name in fields]
+
+    def encode_csv_value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, (datetime.datetime, datetime.date,)):
+            return value.isoformat()
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def write_csv(self, writer, orders):
+        writer = csv.writer(writer)
+        writer.writerow(
+            ['order_%s' % name for name in self.order_fields] +
+            ['group_%s' % name for name in self.group_fields] +
+            ['line_%s' % name for name in self.line_fields])
+        empty_group = [None] * len(self.group_fields)
+        empty_line = [None] * len(self.line_fields)
+
+        count = 0
+        for order in orders:
+            order_row = self.prepare_values(order, self.order_fields)
+            rows = []
+            for group in order['groups']:
+                group_row = self.prepare_values(group, self.group_fields)
+                rows.extend(
+                    order_row + group_row +
+                    self.prepare_values(line, self.line_fields)
+                    for line in group['lines'])
+                if not group['lines']:
+                    rows.append(order_row + group_row + empty_line)
+            if not rows:
+                rows.append(order_row + empty_group + empty_line)
+            writer.writerows([map(self.encode_csv_value, row)
+                              for row in rows])
+            count += 1
+        return count
+
+    def write_jsonl(self, writer, orders):
+        count = 0
+        for order in orders:
+            for group in order['groups']:
+                group['lines'] = [
+                    dict(zip(self.line_fields,
+                             self.prepare_values(line, self.line_fields)))
+                    for line in group['lines']]
+            order['groups'] = [
+                dict(zip(self.group_fields,
+                         self.prepare_values(group, self.group_fields)),
+                     lines=group['lines'])
+                for group in order['groups']]
+            data = dict(zip(self.order_fields,
+                            self.prepare_values(order, self.order_fields)),
+                        groups=order['groups'])
+            writer.write(json.dumps(data, cls=DjangoJSONEncoder,
+                                    sort_keys=True) + '\n')
+            count += 1
+        return count
+
+    def handle(self, *args, **options):
+        model = self.get_model()
+        orders = self.iter_orders(model, self.get_orders(model, options),
+                                  options['chunk_size'])
+
+        output = None
+        if options['output'] == '-':
+            write = lambda data: self.stdout.write(data, ending='')
+        else:
+            output = open(options['output'], 'wb')
+            write = output.write
+
+        try:
+            writer = BufferedWriter(write, options['buffer_size'])
+            if options['format'] == 'csv':
+                count = self.write_csv(writer, orders)
+            else:
+                count = self.write_jsonl(writer, orders)
+            writer.flush()
+        finally:
+            if output:
+                output.close()
+
+        if output and options['verbosity'] > 0:
+            self.stdout.write('Exported %d orders.' % count)
@@ -0,0 +1,80 @@
+import re
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+from ....utils import update_by_pk
+
+HISTORY_LINE = re.compile(
+    r'^(?P<date>.+?) #\S* \S*: (?P<old_status>\S*) -> (?P<new_status>\S*)'
+    r' \((?P<result>\w+)\)$')
+
+
+class Command(BaseCommand):
+    help = ('Move legacy orders status_history text into OrderStatusEvent'
+            ' rows in batches, each batch is committed separately. Lines'
+            ' which can not be parsed are left in status_history.')
+
+    model = None  # order model, Order of shop's order app by default
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Count of orders processed in one transaction'
+                 ' (default 500).')
+
+    def get_model(self):
+        return self.model or import_string(
+            settings.SATCHLESS_SHOP_APP).order_app.Order
+
+    def parse_history(self, order_id, history, event_model):
+        """Return list of events and list of not parsed history lines."""
+        events, skipped = [], []
+        for line in filter(None, history.splitlines()):
+            match = HISTORY_LINE.match(line.strip())
+            date = match and parse_datetime(match.group('date'))
+            if not date:
+                skipped.append(line)
+                continue
+            events.append(event_model(
+                order_id=order_id, date_create=date,
+                old_status=match.group('old_status'),
+                new_status=match.group('new_status'),
+                success=match.group('result') != 'failure'))
+        return events, skipped
+
+    def handle(self, *args, **options):
+        model = self.get_model()
+        event_model = model._meta.get_field('status_events').related_model
+        # orders are processed in pk order, so orders with not parsed lines
+        # left in history are not selected again
+        orders = model._default_manager.exclude(status_history='')
+        orders = orders.order_by('pk').values_list('pk', 'status_history')
+
+        total, skipped, last_pk = 0, 0, 0
+        while True:
+            with transaction.atomic(using=orders.db):
+                batch = list(orders.filter(pk__gt=last_pk).select_for_update()[
+                    :options['batch_size']])
+                events, histories = [], {}
+                for order_id, history in batch:
+                    parsed, lines = self.parse_history(order_id, history,
+                                                       event_model)
+                    events.extend(parsed)
+                    histories[order_id] = '\n'.join(lines)
+                    skipped += len(lines)
+                event_model._default_manager.bulk_create(events)
+                update_by_pk(model._default_manager.all(), 'status_history',
+                             histories)
+            total += len(batch)
+            if batch:
+                last_pk = batch[-1][0]
+            if options['verbosity'] > 1 and batch:
+                self.stdout.write('Processed %d orders.' % total)
+            if len(batch) < options['batch_size']:
+                break
+
+        self.stdout.write(
+            'Migrated status history of %d orders (%d lines left not'
+            ' parsed).' % (total, skipped))
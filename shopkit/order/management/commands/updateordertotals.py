@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = ('Compute denormalised totals of orders and their delivery'
+            ' groups (see Order.update_totals), of orders whose totals'
+            ' were never computed by default, in batches, each batch is'
+            ' committed separately.')
+
+    model = None  # order model, Order of shop's order app by default
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', default=False,
+            help='Recompute totals of all orders.')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Count of orders processed in one transaction'
+                 ' (default 500).')
+
+    def get_model(self):
+        return self.model or import_string(
+            settings.SATCHLESS_SHOP_APP).order_app.Order
+
+    def handle(self, *args, **options):
+        model = self.get_model()
+        orders = model._default_manager.order_by('pk')
+        if not options['all']:
+            orders = orders.filter(total_net__isnull=True)
+        orders = orders.prefetch_related('groups__lines')
+
+        total, last = 0, None
+        while True:
+            batch = orders if last is None else orders.filter(pk__gt=last)
+            with transaction.atomic(using=orders.db):
+                batch = list(batch[:options['batch_size']])
+                for order in batch:
+                    order.update_totals()
+            total += len(batch)
+            if options['verbosity'] > 1 and batch:
+                self.stdout.write('Processed %d orders.' % total)
+            if len(batch) < options['batch_size']:
+                break
+            last = batch[-1].pk
+
+        self.stdout.write('Updated totals of %d orders.' % total)
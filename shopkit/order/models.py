@@ -1,18 +1,22 @@
 # -*- coding: utf-8 -*-
+import json
 import random
+import warnings
+from decimal import Decimal
 from uuid import uuid4
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django_prices.models import PriceField
-from satchless.item import InsufficientStock, ItemSet, ItemLine
+from satchless.item import ItemSet, ItemLine
 from prices import Price
 
-from ..utils import get_unique_uuid_string, countries
-from . import signals
+from ..utils import (get_unique_uuid_string, get_insufficient_lines,
+                     update_by_pk, countries)
+from . import archive, signals
 
 
 class DeliveryInfo(ItemLine):
@@ -64,12 +68,20 @@ class OrderStatus:
 class Order(models.Model, ItemSet):
     SC = OrderStatus  # statuc container
 
+    # cart_fingerprint value of order marked as outdated on cart changes
+    OUTDATED = 'outdated'
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, blank=True, null=True,
         on_delete=models.SET_NULL)
     cart = models.ForeignKey(
         'carts.Cart', blank=True, null=True, on_delete=models.SET_NULL,
         related_name='orders')
+    # fingerprint of cart lines order was partitioned by (see
+    # Cart.get_fingerprint), OUTDATED value means order is outdated, empty
+    # value means unknown (orders created before fingerprints were used)
+    cart_fingerprint = models.CharField(
+        max_length=40, blank=True, editable=False)
 
     token = models.CharField(
         _('token'), max_length=36, unique=True, editable=False,
@@ -81,7 +93,10 @@ class Order(models.Model, ItemSet):
     status = models.CharField(
         _('order status'), max_length=32,
         choices=SC.CHOICES, default=SC.CHECKOUT)
+    # legacy status log, see OrderStatusEvent and migratestatushistory
     status_history = models.TextField(editable=False, blank=True)
+    # incremented on each status change (compare-and-swap, see set_status)
+    version = models.PositiveIntegerField(default=0, editable=False)
 
     billing_first_name = models.CharField(
         _('first name'), max_length=256, blank=True)
@@ -114,6 +129,29 @@ class Order(models.Model, ItemSet):
         _('payment price'), currency=settings.SATCHLESS_DEFAULT_CURRENCY,
         max_digits=12, decimal_places=4, default=0, editable=False)
 
+    # denormalised totals (see update_totals), total includes delivery
+    # and payment prices, empty total means totals were never computed
+    item_count = models.PositiveIntegerField(
+        _('item count'), default=0, editable=False)
+    subtotal_net = models.DecimalField(
+        _('subtotal (net)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+    subtotal_gross = models.DecimalField(
+        _('subtotal (gross)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+    delivery_total_net = models.DecimalField(
+        _('delivery total (net)'), max_digits=12, decimal_places=4,
+        default=0, editable=False)
+    delivery_total_gross = models.DecimalField(
+        _('delivery total (gross)'), max_digits=12, decimal_places=4,
+        default=0, editable=False)
+    total_net = models.DecimalField(
+        _('total (net)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+    total_gross = models.DecimalField(
+        _('total (gross)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+
     date_create = models.DateTimeField(editable=False, auto_now_add=True)
     date_update = models.DateTimeField(editable=False, auto_now=True)
     date_last_status_change = models.DateTimeField(
@@ -124,6 +162,23 @@ class Order(models.Model, ItemSet):
         verbose_name = _('order')
         verbose_name_plural = _('orders')
         ordering = ('-date_last_status_change',)
+        # order history keyset pagination (see OrderApp.get_orders_page)
+        index_together = (('user', 'date_last_status_change', 'id',),)
+
+    # allowed status transitions ({old status: [new statuses]}), any
+    # transition to other status is allowed if None, redefine if required
+    status_transitions = None
+
+    # fields changed by set_status only, not saved by regular save
+    status_fields = ('status', 'version', 'date_last_status_change',)
+
+    # set by set_status if status was changed concurrently by other process
+    status_conflict = False
+
+    # denormalised totals fields, see update_totals
+    total_fields = ('item_count', 'subtotal_net', 'subtotal_gross',
+                    'delivery_total_net', 'delivery_total_gross',
+                    'total_net', 'total_gross',)
 
     def __iter__(self):
         for group in self.groups.all():
@@ -141,6 +196,46 @@ class Order(models.Model, ItemSet):
     def get_default_currency(self):
         return settings.SATCHLESS_DEFAULT_CURRENCY
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Order, cls).from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Status fields of existing order are never saved by regular save,
+        so stale order instance can not overwrite concurrent status change.
+        Changed status of loaded order is set by set_status (with warning,
+        set_status should be used instead).
+        Total is recomputed from subtotal, delivery and payment price columns
+        (if totals were ever computed, see update_totals).
+        """
+        loaded_status = getattr(self, '_loaded_status', None)
+        if self.pk and loaded_status and self.status != loaded_status:
+            warnings.warn('Status of %r should not be changed by save, use'
+                          ' set_status instead.' % self, stacklevel=2)
+            new_status, self.status = self.status, loaded_status
+            self.set_status(new_status)
+            return
+        if self.pk is None or self.total_net is not None:
+            self.set_total_columns()
+        if (self.pk and kwargs.get('update_fields') is None and
+                not kwargs.get('force_insert')):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.status_fields]
+        return super(Order, self).save(*args, **kwargs)
+
+    def can_change_status(self, new_status):
+        """Is transition to new status allowed (see status_transitions)."""
+        if new_status == self.status:
+            return False
+        if self.status_transitions is None:
+            return True
+        return new_status in self.status_transitions.get(self.status, ())
+
     def set_status(self, new_status, failure=False):
         """
         Order new status setting handler.
@@ -148,24 +243,43 @@ class Order(models.Model, ItemSet):
 
         New status value validity should be checked before save,
         if new value is incorrect, call this method with failure=True.
+        Transitions not allowed by status_transitions are failures too.
         On order.status changes should be placed after save, additionally,
         order_status_changed signal will be called if failure is False.
-        See example's project orders.Order.set_status method for more details.
+        Returns failure.
+
+        Status is changed by single conditional (compare-and-swap) update of
+        row with same status and version only, so of concurrent calls only
+        one succeeds, others fail with status_conflict set and order status
+        reloaded. Each call is logged by single insert of OrderStatusEvent.
+        Other order fields (e.g. payment_type_name set by payment provider)
+        are saved first.
         """
-        old_status = self.status
-        self.status_history = '%s\n%s #%s %s: %s -> %s (%s)' % (
-            self.status_history, timezone.now(),
-            self.id, self.token, old_status, new_status,
-            'successfull' if not failure else 'failure',
-        )
-
-        if not failure:
-            self.status = new_status
-            self.date_last_status_change = timezone.now()
-
-        self.save()
-
-        if not failure:
+        old_status, now = self.status, timezone.now()
+        self.status_conflict = False
+        failure = failure or not self.can_change_status(new_status)
+
+        with transaction.atomic():
+            self.save()
+            if not failure:
+                orders = type(self)._default_manager.filter(
+                    pk=self.pk, status=old_status, version=self.version)
+                failure = not orders.update(
+                    status=new_status, version=models.F('version') + 1,
+                    date_last_status_change=now, date_update=now)
+                self.status_conflict = failure
+
+            self.status_events.create(old_status=old_status,
+                                      new_status=new_status,
+                                      success=not failure, date_create=now)
+
+        if self.status_conflict:
+            self.refresh_from_db(fields=self.status_fields)
+            self._loaded_status = self.status
+        elif not failure:
+            self.status = self._loaded_status = new_status
+            self.version += 1
+            self.date_last_status_change = self.date_update = now
             signals.order_status_changed.send(sender=type(self), order=self,
                                               old_status=old_status)
 
@@ -175,46 +289,247 @@ class Order(models.Model, ItemSet):
         return sum([g.get_delivery().get_total() for g in self.groups.all()],
                    Price(0, currency=settings.SATCHLESS_DEFAULT_CURRENCY))
 
+    def set_total_columns(self):
+        """Set total columns by subtotal, delivery and payment prices."""
+        payment_price = self.payment_price or Price(0)
+        self.total_net = (Decimal(self.subtotal_net) +
+                          Decimal(self.delivery_total_net) +
+                          payment_price.net)
+        self.total_gross = (Decimal(self.subtotal_gross) +
+                            Decimal(self.delivery_total_gross) +
+                            payment_price.gross)
+
+    def update_totals(self, groups=None, commit=True):
+        """
+        Recompute denormalised totals of order and its delivery `groups`
+        (all groups with lines by default, see get_groups) and save them
+        with single update query per object (if `commit`). Should be called
+        when lines or delivery prices are changed (payment price is taken
+        into account by save).
+        """
+        groups = self.get_groups() if groups is None else list(groups)
+        for group in groups:
+            group.update_totals(commit=False)
+
+        zero = Decimal(0)
+        self.item_count = sum(group.item_count for group in groups)
+        self.subtotal_net = sum((group.subtotal_net for group in groups),
+                                zero)
+        self.subtotal_gross = sum((group.subtotal_gross for group in groups),
+                                  zero)
+        self.delivery_total_net = sum(
+            (group.get_delivery().price.net for group in groups), zero)
+        self.delivery_total_gross = sum(
+            (group.get_delivery().price.gross for group in groups), zero)
+        self.set_total_columns()
+
+        if commit:
+            for group in groups:
+                group.save_totals()
+            self.save_totals()
+
+    def save_totals(self):
+        type(self)._default_manager.filter(pk=self.pk).update(**{
+            name: getattr(self, name) for name in self.total_fields})
+
+    def update_totals_by_groups(self):
+        """
+        Recompute order totals from totals columns of delivery groups with
+        aggregate and update query (without loading of lines), used when
+        single group or line is changed. All totals are recomputed if any
+        group totals were never computed.
+        """
+        totals = self.groups.order_by().aggregate(
+            groups=models.Count('pk'), computed=models.Count('total_net'),
+            item_count=models.Sum('item_count'),
+            subtotal_net=models.Sum('subtotal_net'),
+            subtotal_gross=models.Sum('subtotal_gross'),
+            delivery_total=models.Sum('delivery_price'))
+        if totals['groups'] != totals['computed']:
+            return self.update_totals()
+
+        delivery_total = totals['delivery_total'] or Decimal(0)
+        delivery_total = getattr(delivery_total, 'net', delivery_total)
+        self.item_count = totals['item_count'] or 0
+        self.subtotal_net = totals['subtotal_net'] or Decimal(0)
+        self.subtotal_gross = totals['subtotal_gross'] or Decimal(0)
+        self.delivery_total_net = self.delivery_total_gross = delivery_total
+        self.set_total_columns()
+        self.save_totals()
+
+    def get_cached_total(self):
+        """
+        Return order total from denormalised columns, without loading of
+        groups and lines (see update_totals), or computed one if totals
+        were never computed.
+        """
+        if self.total_net is None:
+            return self.get_total()
+        return Price(net=self.total_net, gross=self.total_gross,
+                     currency=self.get_default_currency())
+
+    def get_cached_delivery_price(self):
+        if self.total_net is None:
+            return self.get_delivery_price()
+        return Price(net=self.delivery_total_net,
+                     gross=self.delivery_total_gross,
+                     currency=self.get_default_currency())
+
     def get_payment(self):
         return PaymentInfo(name=self.payment_type_name,
                            price=self.payment_price,
                            description=self.payment_type_description)
 
+    def build_delivery_group(self, group):
+        """Return new (not saved) delivery group for partition `group`."""
+        return self.groups.model(order=self,
+                                 shipping_address_required=group.is_shipping)
+
     def create_delivery_group(self, group):
-        return self.groups.create(order=self,
-                                  shipping_address_required=group.is_shipping)
+        delivery_group = self.build_delivery_group(group)
+        delivery_group.save()
+        return delivery_group
+
+    def get_groups(self):
+        """
+        Return delivery groups with lines, prefetched ones if order was
+        loaded with groups and lines (see CheckoutContext), so no queries
+        are made in this case.
+        """
+        if 'groups' in getattr(self, '_prefetched_objects_cache', {}):
+            return list(self.groups.all())
+        return list(self.groups.prefetch_related('lines'))
 
     def is_empty(self):
+        if 'groups' in getattr(self, '_prefetched_objects_cache', {}):
+            return not any(group.lines.all() for group in self.get_groups())
         return not self.groups.filter(lines__isnull=False).exists()
 
-    def check_lines_quantities(self):
-        try:
-            for group in self.groups.all():
-                for line in group.lines.all():
-                    if not line.quantity:
-                        return False
-                    line.variant.check_quantity(line.quantity)
-        except InsufficientStock:
-            return False
-        return True
+    def has_empty_groups(self):
+        if 'groups' in getattr(self, '_prefetched_objects_cache', {}):
+            return not all(group.lines.all() for group in self.get_groups())
+        return self.groups.filter(lines__isnull=True).exists()
 
-    def fix_lines_quantities(self):
-        for group in self.groups.all():
-            for item in group.lines.all():
-                try:
-                    if not item.quantity:
-                        raise InsufficientStock(item.variant)
-                    item.variant.check_quantity(item.quantity)
-                except InsufficientStock:
-                    if item.quantity:
-                        item.quantity = item.variant.get_stock()
-                    if item.quantity:
-                        item.save()
-                    else:
-                        item.delete()
-
-            if not group.lines.exists():
-                group.delete()
+    def is_outdated(self):
+        """
+        Is order in checkout and its cart changed since order was partitioned
+        by it (order was marked as OUTDATED on cart change). Orders in
+        other statuses are never outdated.
+        """
+        return bool(self.status == self.SC.CHECKOUT and self.cart_id and
+                    self.cart_fingerprint == self.OUTDATED)
+
+    def get_lines(self):
+        """Return all order lines (from all groups), see get_groups."""
+        return [line for group in self.get_groups()
+                for line in group.lines.all()]
+
+    def check_lines_quantities(self, **kwargs):
+        return not get_insufficient_lines(self.get_lines(), **kwargs)
+
+    def fix_lines_quantities(self, **kwargs):
+        """
+        Reduce quantities of lines with insufficient stock to available
+        stock level (or delete lines) and delete empty delivery groups,
+        all changes are applied with bulk queries. Cart fingerprint of
+        changed order is cleared, so order is re-partitioned on next
+        checkout_app.get_order_from_cart call.
+        """
+        insufficient = get_insufficient_lines(self.get_lines(), **kwargs)
+        if insufficient:
+            lines = type(insufficient[0][0])._default_manager
+            update_by_pk(lines.all(), 'quantity', {
+                line.pk: quantity for line, quantity in insufficient
+                if quantity})
+            lines.filter(pk__in=[
+                line.pk for line, quantity in insufficient if not quantity
+            ]).delete()
+
+        self.groups.filter(lines__isnull=True).delete()
+        if insufficient:
+            self.update_totals(groups=list(self.groups.prefetch_related(
+                'lines')))
+            self.cart_fingerprint = ''
+            type(self)._default_manager.filter(pk=self.pk).update(
+                cart_fingerprint='')
+
+
+class OrderStatusEvent(models.Model):
+    """Append-only log of order status changes (see Order.set_status)."""
+
+    order = models.ForeignKey(
+        'orders.Order', editable=False, on_delete=models.CASCADE,
+        related_name='status_events')
+
+    old_status = models.CharField(
+        _('old status'), max_length=32, blank=True, editable=False)
+    new_status = models.CharField(
+        _('new status'), max_length=32, editable=False)
+    success = models.BooleanField(_('success'), default=True, editable=False)
+
+    date_create = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        abstract = True
+        ordering = ('date_create', 'id',)
+
+    def __unicode__(self):
+        return u'%s -> %s (%s)' % (self.old_status, self.new_status,
+                                   'success' if self.success else 'failure',)
+
+
+class ArchivedOrder(models.Model):
+    """
+    Order in terminal status moved out of live tables (see archiveorders
+    command), with all its data (groups, lines and status events) dumped
+    to single JSON value, see get_order.
+    """
+
+    token = models.CharField(
+        _('token'), max_length=36, unique=True, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, blank=True, null=True,
+        on_delete=models.SET_NULL, related_name='+')
+    status = models.CharField(_('order status'), max_length=32)
+
+    total_net = models.DecimalField(
+        _('total (net)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+    total_gross = models.DecimalField(
+        _('total (gross)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+
+    data = models.TextField(editable=False)
+
+    date_create = models.DateTimeField(editable=False)
+    date_last_status_change = models.DateTimeField(editable=False)
+    date_archive = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        abstract = True
+        verbose_name = _('archived order')
+        verbose_name_plural = _('archived orders')
+        ordering = ('-date_last_status_change',)
+
+    def __unicode__(self):
+        return u'Archived order (#%s, %s)' % (self.token, self.status,)
+
+    @classmethod
+    def build_from_data(cls, data):
+        """Return new (not saved) archived order by order data."""
+        return cls(token=data['token'], user_id=data['user_id'],
+                   status=data['status'], total_net=data['total_net'],
+                   total_gross=data['total_gross'],
+                   date_create=data['date_create'],
+                   date_last_status_change=data['date_last_status_change'],
+                   data=archive.dumps_order(data))
+
+    def get_order(self, order_model):
+        """
+        Return restored (not saved) order of `order_model` and list of its
+        (group, lines) pairs, so it can be rendered as live one.
+        """
+        return archive.load_order(order_model, json.loads(self.data))
 
 
 class DeliveryGroup(models.Model, ItemSet):
@@ -233,6 +548,23 @@ class DeliveryGroup(models.Model, ItemSet):
         max_digits=12, decimal_places=4,
         currency=settings.SATCHLESS_DEFAULT_CURRENCY)
 
+    # denormalised totals (see update_totals), total includes delivery
+    # price, empty total means totals were never computed
+    item_count = models.PositiveIntegerField(
+        _('item count'), default=0, editable=False)
+    subtotal_net = models.DecimalField(
+        _('subtotal (net)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+    subtotal_gross = models.DecimalField(
+        _('subtotal (gross)'), max_digits=12, decimal_places=4, default=0,
+        editable=False)
+    total_net = models.DecimalField(
+        _('total (net)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+    total_gross = models.DecimalField(
+        _('total (gross)'), max_digits=12, decimal_places=4,
+        blank=True, null=True, editable=False)
+
     shipping_address_required = models.BooleanField(
         default=False, editable=False)
 
@@ -262,6 +594,10 @@ class DeliveryGroup(models.Model, ItemSet):
     class Meta:
         abstract = True
 
+    # denormalised totals fields, see update_totals
+    total_fields = ('item_count', 'subtotal_net', 'subtotal_gross',
+                    'total_net', 'total_gross',)
+
     def __iter__(self):
         for i in self.lines.all():
             yield i
@@ -269,19 +605,83 @@ class DeliveryGroup(models.Model, ItemSet):
         if delivery:
             yield delivery
 
+    def save(self, *args, **kwargs):
+        """
+        Keep total consistent with (possibly changed) delivery price and
+        update order totals if group total is changed.
+        """
+        totals = (self.total_net, self.total_gross,)
+        if self.pk is None or self.total_net is not None:
+            self.set_total_columns()
+        result = super(DeliveryGroup, self).save(*args, **kwargs)
+        if totals != (self.total_net, self.total_gross,):
+            self.order.update_totals_by_groups()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(DeliveryGroup, self).delete(*args, **kwargs)
+        self.order.update_totals_by_groups()
+        return result
+
     def get_default_currency(self):
         return settings.SATCHLESS_DEFAULT_CURRENCY
 
+    def set_total_columns(self):
+        """Set total columns by subtotal and delivery price."""
+        delivery_price = self.get_delivery().price or Price(0)
+        self.total_net = Decimal(self.subtotal_net) + delivery_price.net
+        self.total_gross = Decimal(self.subtotal_gross) + delivery_price.gross
+
+    def update_totals(self, lines=None, commit=True):
+        """
+        Recompute denormalised totals from `lines` (group lines, prefetched
+        ones if any, by default) and save them with single update query
+        (if `commit`), order totals should be updated too, see
+        Order.update_totals.
+        """
+        lines = self.lines.all() if lines is None else list(lines)
+        zero = Decimal(0)
+        self.item_count = sum(line.quantity for line in lines)
+        self.subtotal_net = sum((line.unit_price_net * line.quantity
+                                 for line in lines), zero)
+        self.subtotal_gross = sum((line.unit_price_gross * line.quantity
+                                   for line in lines), zero)
+        self.set_total_columns()
+        if commit:
+            self.save_totals()
+
+    def save_totals(self):
+        type(self)._default_manager.filter(pk=self.pk).update(**{
+            name: getattr(self, name) for name in self.total_fields})
+
+    def get_cached_total(self):
+        """
+        Return group total from denormalised columns or computed one if
+        totals were never computed.
+        """
+        if self.total_net is None:
+            return self.get_total()
+        return Price(net=self.total_net, gross=self.total_gross,
+                     currency=self.get_default_currency())
+
     def get_delivery(self):
         return DeliveryInfo(name=self.delivery_type_name,
                             price=self.delivery_price,
                             description=self.delivery_type_description)
 
-    def create_order_line(self, variant, quantity, price, name=None):
-        return self.lines.create(
-            variant=variant, quantity=quantity, name=name or unicode(variant),
+    def build_order_line(self, variant, quantity, price, name=None):
+        """Return new (not saved) order line of delivery group."""
+        return self.lines.model(
+            delivery_group=self, variant=variant, quantity=quantity,
+            name=name or unicode(variant),
             unit_price_net=price.net, unit_price_gross=price.gross)
 
+    def create_order_line(self, variant, quantity, price, name=None):
+        order_line = self.build_order_line(variant, quantity, price,
+                                           name=name)
+        order_line.save()
+        return order_line
+
 
 class OrderLine(models.Model, ItemLine):
     delivery_group = models.ForeignKey(
@@ -306,6 +706,34 @@ class OrderLine(models.Model, ItemLine):
     class Meta:
         abstract = True
 
+    # fields of line affecting delivery group and order totals
+    total_fields = ('delivery_group', 'quantity', 'unit_price_net',
+                    'unit_price_gross',)
+
+    def save(self, *args, **kwargs):
+        result = super(OrderLine, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & set(
+                self.total_fields):
+            self.update_totals()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(OrderLine, self).delete(*args, **kwargs)
+        self.update_totals()
+        return result
+
+    def update_totals(self):
+        """
+        Recompute totals of line's delivery group (by lines from db) and
+        of its order, used if single line is saved or deleted (bulk
+        changes of checkout update totals by Order.update_totals).
+        """
+        group = self.delivery_group
+        group.update_totals(lines=group.lines.model._default_manager.filter(
+            delivery_group=group))
+        group.order.update_totals_by_groups()
+
     def get_price_per_item(self, **kwargs):
         return Price(net=self.unit_price_net, gross=self.unit_price_gross,
                      currency=self.delivery_group.get_default_currency())
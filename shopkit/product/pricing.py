@@ -0,0 +1,30 @@
+from uuid import uuid4
+from django.core.cache import cache
+
+
+PRICING_VERSION_KEY = 'shopkit-pricing-version'
+
+
+def get_pricing_version():
+    """
+    Return catalog pricing version, it is changed by bump_pricing_version
+    on any change of prices (cached cart totals computed with other
+    version are recomputed). Version is kept in default cache, so cache
+    shared by all processes should be used.
+    """
+    version = cache.get(PRICING_VERSION_KEY)
+    if version is None:
+        # new version if it was never set or evicted from cache
+        version = uuid4().hex[:8]
+        if not cache.add(PRICING_VERSION_KEY, version, None):
+            version = cache.get(PRICING_VERSION_KEY, version)
+    return version
+
+
+def bump_pricing_version(**kwargs):
+    """
+    Change catalog pricing version, may be connected to post_save and
+    post_delete signals of all models affecting prices (queryset updates
+    of such models should be followed by explicit call).
+    """
+    cache.set(PRICING_VERSION_KEY, uuid4().hex[:8], None)
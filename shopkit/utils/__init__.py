@@ -1,5 +1,65 @@
 from uuid import uuid4
+from django.db.models import Case, Value, When
+from satchless.item import InsufficientStock
 
 
 def get_unique_uuid_string():
     return str(uuid4())
+
+
+def update_by_pk(queryset, field_name, values, **kwargs):
+    """
+    Update field value of many objects ({pk: value}) with single query,
+    keyword arguments are updated as is for all objects.
+    Returns count of updated rows.
+    """
+    if not values:
+        return 0
+    field = queryset.model._meta.get_field(field_name)
+    whens = [When(pk=pk, then=Value(value)) for pk, value in values.items()]
+    kwargs[field_name] = Case(*whens, output_field=field)
+    return queryset.filter(pk__in=values.keys()).update(**kwargs)
+
+
+def get_insufficient_lines(lines, **kwargs):
+    """
+    Check stock levels for all lines (cart or order lines) at once.
+    Returns list of (line, quantity) pairs for lines with zero quantity or
+    with quantity exceeding variant's stock, where quantity is the maximal
+    available quantity for line (lines without variant have no stock).
+
+    If variant's default manager provides check_quantities method (see
+    shopkit.contrib.stock.singlestore), all variants are checked with single
+    query, otherwise each variant is checked by its check_quantity method.
+    Keyword arguments are passed to check_quantities method as is.
+    """
+    lines = list(lines)
+    if not lines:
+        return []
+
+    model = lines[0]._meta.get_field('variant').related_model
+    manager = model._default_manager
+    if hasattr(manager, 'check_quantities'):
+        quantities = {}
+        for line in lines:
+            if line.variant_id:
+                quantities[line.variant_id] = max(
+                    quantities.get(line.variant_id, 0), line.quantity)
+        shortfalls = manager.check_quantities(quantities, **kwargs)
+
+        def get_stock(line):
+            return shortfalls.get(line.variant_id)
+    else:
+        def get_stock(line):
+            try:
+                line.variant.check_quantity(line.quantity)
+            except InsufficientStock as e:
+                return e.item.get_stock()
+            return None
+
+    insufficient = []
+    for line in lines:
+        stock = get_stock(line) if line.variant_id else 0
+        if stock is not None or not line.quantity:
+            insufficient.append((line, stock or 0,))
+    return insufficient